@@ -1,37 +1,185 @@
-import face_recognition
-import numpy as np
 import base64
-import cv2
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, stream_with_context
 from flask_cors import CORS
+from flask_sock import Sock
 import datetime # Import datetime for timestamps
+import json
+import os
+import tempfile
+import threading
+import time
+
+from gallery import create_gallery, person_name, DEFAULT_TOLERANCE, TEMPLATE_SEPARATOR
+from storage import EmbeddingStore, EncodingCache, AttendanceLog
+from state import GalleryState, AttendanceWriter
+from workers import EncoderPool, PoolSaturated
+from imaging import decode_bytes, detect_faces, encode_faces, encode_locations, DECODE_REDUCTIONS
+from tracking import FaceTracker
+from enrollment import directory_images, archive_images, enroll, TEMPLATE_MODES
+from metrics import (REGISTRY, Counter, Gauge, Histogram, stage, start_request_timings,
+                     request_timings, server_timing_header)
 
 app = Flask(__name__)
 CORS(app) # Enable CORS for all routes
-
-# --- In-memory Storage ---
-# These dictionaries will store data only while the server is running.
-# All data will be lost when the server restarts.
-known_face_encodings = {} # Stores { "name": face_encoding_array }
-# Stores { "name": [{"timestamp": "iso_string", "type": "check-in/out"}, ...] }
-attendance_records = {}
+sock = Sock(app) # WebSocket routes (camera streaming)
+
+# --- Configuration ---
+# Gallery search backend: 'exact' (brute force) or 'ivf' (approximate, for very large galleries).
+FACE_INDEX = os.environ.get('FACE_INDEX', 'exact')
+# IVF only: clusters scanned per probe (higher = better recall, slower) and PQ bytes per face (0 = off).
+FACE_INDEX_NPROBE = int(os.environ.get('FACE_INDEX_NPROBE', 8))
+FACE_INDEX_PQ_M = int(os.environ.get('FACE_INDEX_PQ_M', 0))
+# Where face encodings and attendance logs are persisted.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EMBEDDINGS_DIR = os.environ.get('EMBEDDINGS_DIR', os.path.join(BASE_DIR, 'embeddings'))
+ATTENDANCE_LOG_DIR = os.environ.get('ATTENDANCE_LOG_DIR', os.path.join(BASE_DIR, 'attendance_logs'))
+# Seconds between fsyncs of the stores; requests only flush to the OS.
+SYNC_INTERVAL = float(os.environ.get('SYNC_INTERVAL', 5))
+# Page size for paginated /get_attendance queries, and the most a client may ask for.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Processes used by /recognize_batch for detection and encoding, how many images may be
+# queued for them before requests get 429, and the most images one request may carry.
+# Every server process has its own pool, so the default splits the CPUs between the
+# WEB_CONCURRENCY server processes (gunicorn also reads it as its worker count).
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+RECOGNITION_QUEUE_SIZE = int(os.environ.get('RECOGNITION_QUEUE_SIZE', RECOGNITION_WORKERS * 8))
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', 32))
+# Decode uploads at 1/1, 1/2, 1/4 or 1/8 resolution (JPEG/WebP decode straight to the smaller size).
+DECODE_REDUCTION = int(os.environ.get('DECODE_REDUCTION', 1))
+if DECODE_REDUCTION not in DECODE_REDUCTIONS:
+    raise ValueError(f"DECODE_REDUCTION must be one of {', '.join(map(str, DECODE_REDUCTIONS))}, not {DECODE_REDUCTION}.")
+# Frames wider than this are shrunk before face detection (0 = never); encoding still uses full resolution.
+DETECT_MAX_WIDTH = int(os.environ.get('DETECT_MAX_WIDTH', 640))
+# Streaming mode: seconds after a person's last attendance event during which a new
+# track of them records nothing, and seconds between re-encodes of a still-unknown face.
+ATTENDANCE_COOLDOWN = float(os.environ.get('ATTENDANCE_COOLDOWN', 60))
+STREAM_RETRY_INTERVAL = float(os.environ.get('STREAM_RETRY_INTERVAL', 1.0))
+# Bulk enrollment: cache of encodings by image content hash, the directory that server-side
+# 'directory' imports must be inside, and how several photos of one person are stored.
+ENCODING_CACHE_DIR = os.environ.get('ENCODING_CACHE_DIR', os.path.join(EMBEDDINGS_DIR, 'cache'))
+ENROLL_ROOT = os.environ.get('ENROLL_ROOT', BASE_DIR)
+ENROLL_TEMPLATES = os.environ.get('ENROLL_TEMPLATES', 'mean')
+# Add a Server-Timing header with per-stage durations to every response.
+TIMING_HEADER = os.environ.get('TIMING_HEADER', '0').lower() in ('1', 'true', 'yes')
+
+# --- Storage ---
+# Encodings and attendance are persisted on disk and shared by all worker processes.
+# The structures below are this process's view of them. Requests read immutable
+# snapshots without locking; each store's shared version tells when to refresh them.
+embedding_store = EmbeddingStore(EMBEDDINGS_DIR)
+attendance_log = AttendanceLog(ATTENDANCE_LOG_DIR)
+encoding_cache = EncodingCache(ENCODING_CACHE_DIR)
+
+# Registered faces (one or more reference encodings per person), searched by brute force or through the approximate IVF index.
+# Writers go through face_gallery (one at a time); readers search face_gallery.current().
+if FACE_INDEX == 'ivf':
+    face_gallery = GalleryState(embedding_store, create_gallery('ivf', nprobe=FACE_INDEX_NPROBE, pq_m=FACE_INDEX_PQ_M))
+else:
+    face_gallery = GalleryState(embedding_store, create_gallery('exact'))
+# Attendance history indexed by user and day. Every change runs on the writer's own thread;
+# readers use attendance_writer.current(), an immutable AttendanceIndex.
+attendance_writer = AttendanceWriter(attendance_log)
+
+# Worker processes for batch recognition; started (and models loaded) at startup.
+encoder_pool = EncoderPool(RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE,
+                           reduction=DECODE_REDUCTION, detect_max_width=DETECT_MAX_WIDTH)
+
+# --- Metrics ---
+# Per-process; exposed on /metrics. Stage timings (facetrack_stage_seconds) come from metrics.stage().
+REQUESTS = REGISTRY.register(Counter(
+    'facetrack_requests_total', 'HTTP requests handled.', ['endpoint', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'facetrack_request_seconds', 'HTTP request latency.', ['endpoint']))
+REGISTRY.register(Gauge(
+    'facetrack_gallery_size', 'Registered faces in the gallery.')).set_function(lambda: len(face_gallery.snapshot))
+REGISTRY.register(Gauge(
+    'facetrack_gallery_snapshots', 'Gallery snapshots published by this process.')).set_function(lambda: face_gallery.version)
+REGISTRY.register(Gauge(
+    'facetrack_encoder_queue_depth', 'Images queued or in progress in the encoder pool.')).set_function(lambda: encoder_pool.pending)
+REGISTRY.register(Gauge(
+    'facetrack_attendance_events', 'Attendance events in the index.')).set_function(lambda: len(attendance_writer.snapshot))
+STREAM_CONNECTIONS = REGISTRY.register(Gauge(
+    'facetrack_stream_connections', 'Open /recognize_stream WebSockets.'))
+STREAM_CONNECTIONS.set(0)
 
 # --- Helper Functions ---
 
-def decode_image(base64_string):
+def load_state():
+    """
+    Loads all encodings and attendance from disk. Encodings come straight from the
+    memory-mapped store, so nothing is re-read from images or re-encoded.
+    """
+    face_gallery.load()
+    attendance_writer.load()
+
+def sync_state():
+    """
+    Picks up what was written to the stores since the last call, by this or any other
+    worker process: every encoding change, and attendance appended to the latest day
+    already loaded or to today. Requests don't need this (they check the shared
+    versions). Code that wrote attendance for earlier days should call load_state().
+    """
+    with stage('sync_state'):
+        face_gallery.sync()
+        attendance_writer.sync()
+
+def maintain_stores():
+    """
+    Runs in the background: periodically fsyncs both stores and compacts them
+    once deletions have piled up.
+    """
+    while True:
+        time.sleep(SYNC_INTERVAL)
+        try:
+            face_gallery.maintain()
+            attendance_writer.maintain()
+        except Exception as e:
+            print(f"Error during store maintenance: {e}")
+
+def image_bytes_from_base64(base64_string):
+    """
+    Decodes a base64 string (optionally a data URL) into the encoded image bytes.
+    Returns None if it is not valid base64.
+    """
+    try:
+        with stage('base64_decode'):
+            # Remove the "data:image/png;base64," prefix if present
+            if ',' in base64_string:
+                base64_string = base64_string.split(',')[1]
+            return base64.b64decode(base64_string)
+    except Exception as e:
+        print(f"Error decoding base64 image: {e}")
+        return None
+
+def read_image_upload(field='image'):
+    """
+    Returns (image_bytes, fields) from the current request. The image may be sent as
+    - a raw body with an image/* Content-Type (e.g. image/jpeg, image/webp), other fields in the query string,
+    - a multipart/form-data file named `field`, other fields as form fields,
+    - JSON with `field` as a base64 string or data URL.
+    image_bytes is None when no image was sent at all.
+    """
+    mimetype = request.mimetype
+    if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+        return request.get_data() or None, request.args
+    if mimetype == 'multipart/form-data':
+        upload = request.files.get(field)
+        return (upload.read() or None) if upload else None, request.form
+    data = request.get_json(silent=True) or {}
+    image_data = data.get(field)
+    if not isinstance(image_data, str) or not image_data:
+        return None, data
+    return image_bytes_from_base64(image_data) or b'', data
+
+def decode_image(image_bytes):
     """
-    Decodes a base64 string into an OpenCV image (numpy array).
+    Decodes encoded image bytes into an OpenCV image (numpy array),
+    at reduced resolution when DECODE_REDUCTION is set.
     """
     try:
-        # Remove the "data:image/png;base64," prefix if present
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        
-        # Decode the base64 string
-        nparr = np.frombuffer(base64.b64decode(base64_string), np.uint8)
-        # Read the image using OpenCV
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return img
+        return decode_bytes(image_bytes, DECODE_REDUCTION)
     except Exception as e:
         print(f"Error decoding image: {e}")
         return None
@@ -44,35 +192,121 @@ def get_face_encoding(image):
     if image is None:
         return None
 
-    # Convert BGR (OpenCV default) to RGB (face_recognition expects RGB)
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    # Find all face locations in the image
-    face_locations = face_recognition.face_locations(rgb_image)
-    
-    if len(face_locations) > 0:
-        # Get face encodings for all detected faces
-        encodings = face_recognition.face_encodings(rgb_image, face_locations)
-        if encodings:
-            return encodings[0] # Return the encoding of the first face found
+    faces = encode_faces(image, DETECT_MAX_WIDTH)
+    if faces:
+        return faces[0][1] # Return the encoding of the first face found
     return None
 
+def event_json(event):
+    return {'name': event['name'], 'timestamp': event['timestamp'], 'type': event['type']}
+
+def not_modified(version):
+    response = app.response_class(status=304)
+    response.set_etag(version)
+    return response
+
+def record_attendance(name, cooldown=0):
+    """
+    Records a check-in or check-out for a recognized user, based on their last entry today.
+    With a cooldown (seconds), records nothing if their last entry is more recent than that.
+    Returns (action_type, sassy_message), or (None, None) if nothing was recorded.
+    """
+    current_time = datetime.datetime.now()
+
+    # The attendance writer looks up the user's last entry today and appends the new one
+    # in a single step, so two recognitions of the same person can't both check in.
+    with stage('attendance_update'):
+        recorded = attendance_writer.record(name, current_time, cooldown)
+    if recorded is None:
+        return None, None
+    action_type, previous_type = recorded
+
+    if previous_type == "check-in":
+        sassy_message = f"Alright, {name}! Time to wrap it up! You're officially checked out. See ya!"
+    elif previous_type == "check-out":
+        sassy_message = f"Welcome back, {name}! Let's get this day going! You're checked in!"
+    else: # First entry for today
+        sassy_message = f"Hello, {name}! Ready to conquer the day? You're officially checked in!"
+
+    print(f"Recorded {action_type} for: {name} at {current_time.isoformat()}.")
+    return action_type, sassy_message
+
+def match_face(encoding):
+    """
+    Finds the closest registered face within tolerance. Returns (name or None, distance).
+    A person with several reference encodings matches on whichever is closest.
+    """
+    with stage('gallery_search'):
+        key, distance = face_gallery.current().best_match(encoding, tolerance=DEFAULT_TOLERANCE)
+    return (person_name(key) if key else None), distance
+
+def process_stream_frame(tracker, image):
+    """
+    Runs one camera frame through the tracker. Only new or still-unrecognized tracks are
+    encoded, and each track records at most one attendance event.
+    Returns {'tracks': [...], 'events': [...], 'encoded': number of faces encoded}.
+    """
+    now = time.monotonic()
+    rgb_image, face_locations = detect_faces(image, DETECT_MAX_WIDTH)
+    tracks = tracker.update([tuple(int(v) for v in location) for location in face_locations], now)
+
+    to_encode = [track for track in tracks if tracker.needs_encoding(track, now)]
+    for track, encoding in zip(to_encode, encode_locations(rgb_image, [track.box for track in to_encode])):
+        track.last_encoded = now
+        track.name, track.distance = match_face(encoding)
+
+    events = []
+    for track in tracks:
+        if track.name is None or track.recorded:
+            continue
+        track.recorded = True
+        action_type, sassy_message = record_attendance(track.name, cooldown=ATTENDANCE_COOLDOWN)
+        if action_type is None:
+            continue # Same person seen again within the cooldown: nothing to record
+        events.append({'track_id': track.id, 'name': track.name, 'action_type': action_type, 'message': sassy_message})
+
+    return {'tracks': [track.to_json(DECODE_REDUCTION) for track in tracks], 'events': events, 'encoded': len(to_encode)}
+
 # --- API Endpoints ---
 
+@app.before_request
+def start_request_metrics():
+    request.start_time = time.perf_counter()
+    start_request_timings()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - request.start_time, endpoint=endpoint)
+    if TIMING_HEADER:
+        response.headers['Server-Timing'] = server_timing_header(request_timings())
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus-style metrics for this worker process: request counts and latency,
+    per-stage timings, gallery size, encoder queue depth and open streams.
+    """
+    return app.response_class(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/register_face', methods=['POST'])
 def register_face():
     """
-    Registers a new face with a given name in in-memory storage.
-    Expects JSON with 'image' (base64 string) and 'name'.
+    Registers a new face with a given name in the embedding store.
+    Expects JSON with 'image' (base64 string) and 'name', a multipart upload with an
+    'image' file and a 'name' field, or a raw image body with ?name= in the query string.
     """
-    data = request.get_json()
-    image_data = data.get('image')
-    name = data.get('name')
+    image_bytes, fields = read_image_upload()
+    name = fields.get('name')
 
-    if not image_data or not name:
+    if image_bytes is None or not name:
         return jsonify({'success': False, 'message': 'Image data and name are required.'}), 400
+    if TEMPLATE_SEPARATOR in name:
+        return jsonify({'success': False, 'message': 'Name contains an invalid character.'}), 400
 
-    image = decode_image(image_data)
+    image = decode_image(image_bytes)
     if image is None:
         return jsonify({'success': False, 'message': 'Invalid image data.'}), 400
 
@@ -82,9 +316,9 @@ def register_face():
         return jsonify({'success': False, 'message': 'No face detected in the image.'}), 400
 
     try:
-        # Store the face encoding in the in-memory dictionary
-        known_face_encodings[name] = face_encoding.tolist() # Store as list for consistency
-        print(f"Registered face for: {name} in memory.")
+        # Persist the face encoding (replacing any bulk-enrolled ones) and publish a gallery snapshot with it
+        face_gallery.store_templates({name: [face_encoding]})
+        print(f"Registered face for: {name}.")
         return jsonify({'success': True, 'message': f'Face registered for {name}.'})
     except Exception as e:
         print(f"Error registering face: {e}")
@@ -93,18 +327,18 @@ def register_face():
 @app.route('/recognize_face', methods=['POST'])
 def recognize_face():
     """
-    Recognizes a face from the provided image and records attendance in in-memory storage.
+    Recognizes a face from the provided image and records attendance in the attendance log.
     Determines if it's a check-in or check-out based on the last entry for the day.
-    Expects JSON with 'image' (base64 string).
+    Expects JSON with 'image' (base64 string), a multipart upload with an 'image' file,
+    or a raw image body (Content-Type image/jpeg, image/webp, ...).
     Returns recognized name, action type, and a sassy message.
     """
-    data = request.get_json()
-    image_data = data.get('image')
+    image_bytes, _ = read_image_upload()
 
-    if not image_data:
+    if image_bytes is None:
         return jsonify({'success': False, 'message': 'Image data is required.'}), 400
 
-    image = decode_image(image_data)
+    image = decode_image(image_bytes)
     if image is None:
         return jsonify({'success': False, 'message': 'Invalid image data.'}), 400
 
@@ -114,57 +348,19 @@ def recognize_face():
         sassy_message = "Whoops! No face detected. Are you hiding? Try again!"
         return jsonify({'success': True, 'name': None, 'message': sassy_message, 'action_type': None})
 
-    recognized_name = None
     try:
-        # Compare the unknown face with all known faces from in-memory dictionary
-        for name, known_encoding_list in known_face_encodings.items():
-            known_encoding = np.array(known_encoding_list) # Convert list back to numpy array
-            # Compare faces using a tolerance (lower is stricter)
-            # A common tolerance is 0.6. Adjust as needed.
-            matches = face_recognition.compare_faces([known_encoding], unknown_face_encoding, tolerance=0.6)
-            if matches[0]:
-                recognized_name = name
-                break # Found a match, no need to check further
+        # Compare the unknown face against every known face in one batched distance
+        # computation and take the closest one within tolerance (lower is stricter).
+        recognized_name, match_distance = match_face(unknown_face_encoding)
 
         if recognized_name:
-            current_time = datetime.datetime.now()
-            current_timestamp_iso = current_time.isoformat()
-            today_date = current_time.date()
-
-            # Get attendance for the recognized user
-            user_attendance = attendance_records.get(recognized_name, [])
-
-            # Filter today's entries
-            today_entries = [
-                entry for entry in user_attendance
-                if datetime.datetime.fromisoformat(entry['timestamp']).date() == today_date
-            ]
-
-            action_type = "check-in"
-            sassy_message = ""
-
-            if today_entries:
-                last_entry = today_entries[-1]
-                if last_entry['type'] == "check-in":
-                    action_type = "check-out"
-                    sassy_message = f"Alright, {recognized_name}! Time to wrap it up! You're officially checked out. See ya!"
-                else: # last_entry['type'] == "check-out"
-                    action_type = "check-in"
-                    sassy_message = f"Welcome back, {recognized_name}! Let's get this day going! You're checked in!"
-            else: # First entry for today
-                action_type = "check-in"
-                sassy_message = f"Hello, {recognized_name}! Ready to conquer the day? You're officially checked in!"
-
-            # Add the new entry to the user's attendance records
-            user_attendance.append({"timestamp": current_timestamp_iso, "type": action_type})
-            attendance_records[recognized_name] = user_attendance # Update the main dictionary
-
-            print(f"Recorded {action_type} for: {recognized_name} at {current_timestamp_iso} in memory.")
+            action_type, sassy_message = record_attendance(recognized_name)
             return jsonify({
                 'success': True,
                 'name': recognized_name,
                 'message': sassy_message,
-                'action_type': action_type # Send action type for frontend to potentially use
+                'action_type': action_type, # Send action type for frontend to potentially use
+                'distance': match_distance
             })
         else:
             sassy_message = "Whoops! Face not recognized. Are you registered? Try again!"
@@ -174,19 +370,181 @@ def recognize_face():
         sassy_message = f"Recognition failed due to an internal error: {e}"
         return jsonify({'success': False, 'message': sassy_message, 'action_type': None}), 500
 
+@app.route('/recognize_batch', methods=['POST'])
+def recognize_batch():
+    """
+    Recognizes every face in each of several frames and records attendance for each
+    recognized person (once per request, even if they appear in several frames).
+    Detection and encoding run in the worker process pool.
+    Expects JSON with 'images' (list of base64 strings) and optionally 'record' (default true),
+    or a multipart upload with several 'images' files and an optional 'record' field.
+    Returns one result per image: {'faces': [{'box', 'name', 'distance', 'action_type', 'message'}, ...]}
+    or {'error': ...}. Responds 429 with Retry-After when the pool queue is full.
+    """
+    if request.mimetype == 'multipart/form-data':
+        payloads = [upload.read() for upload in request.files.getlist('images')]
+        record = request.form.get('record', 'true').lower() != 'false'
+    else:
+        data = request.get_json(silent=True) or {}
+        images = data.get('images')
+        record = data.get('record', True)
+        if not isinstance(images, list):
+            images = []
+        payloads = [image_bytes_from_base64(image) if isinstance(image, str) else None for image in images]
+
+    if not payloads:
+        return jsonify({'success': False, 'message': "A non-empty 'images' list is required."}), 400
+    if len(payloads) > MAX_BATCH_IMAGES:
+        return jsonify({'success': False, 'message': f'At most {MAX_BATCH_IMAGES} images per request.'}), 400
+
+    try:
+        futures = iter(encoder_pool.submit_many([payload for payload in payloads if payload]))
+    except PoolSaturated:
+        response = jsonify({'success': False, 'message': 'Recognition queue is full. Try again shortly.'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+
+    results = []
+    recorded = {} # { "name": (action_type, sassy_message) } for people already recorded in this batch
+    try:
+        for payload in payloads:
+            if not payload:
+                results.append({'error': 'Invalid image data.', 'faces': []})
+                continue
+            try:
+                with stage('pool_wait'):
+                    detections = next(futures).result()
+            except ValueError as e:
+                results.append({'error': str(e), 'faces': []})
+                continue
+
+            faces = []
+            for (top, right, bottom, left), encoding in detections:
+                name, distance = match_face(encoding)
+                face = {
+                    'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
+                    'name': name,
+                    'distance': distance,
+                    'action_type': None,
+                    'message': None
+                }
+                if name and record:
+                    if name not in recorded:
+                        recorded[name] = record_attendance(name)
+                    face['action_type'], face['message'] = recorded[name]
+                faces.append(face)
+            results.append({'faces': faces})
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        print(f"Error during batch recognition: {e}")
+        return jsonify({'success': False, 'message': f'Batch recognition failed due to an internal error: {e}'}), 500
+
+@sock.route('/recognize_stream')
+def recognize_stream(ws):
+    """
+    WebSocket for continuous camera streams. The client sends frames (binary JPEG/WebP/PNG
+    messages, or base64 text) and receives one JSON reply per frame:
+    {'tracks': [{'id', 'box', 'name', 'distance'}, ...], 'events': [{'track_id', 'name', 'action_type', 'message'}, ...]}.
+    Faces are tracked across frames, so each person is encoded once and records one
+    attendance event per track (none within ATTENDANCE_COOLDOWN of their last one).
+    Clients should send the next frame only after the reply to the previous one arrives.
+    With TIMING_HEADER on, each reply also carries 'timings' (stage -> milliseconds).
+    """
+    tracker = FaceTracker(retry_interval=STREAM_RETRY_INTERVAL)
+    STREAM_CONNECTIONS.inc()
+    try:
+        while True:
+            start_request_timings()
+            message = ws.receive()
+            image_bytes = message if isinstance(message, bytes) else image_bytes_from_base64(message)
+            image = decode_image(image_bytes)
+            if image is None:
+                ws.send(json.dumps({'success': False, 'message': 'Invalid image data.'}))
+                continue
+            try:
+                reply = {'success': True, **process_stream_frame(tracker, image)}
+                if TIMING_HEADER:
+                    reply['timings'] = {name: seconds * 1000 for name, seconds in request_timings().items()}
+                ws.send(json.dumps(reply))
+            except Exception as e:
+                print(f"Error during stream recognition: {e}")
+                ws.send(json.dumps({'success': False, 'message': f'Recognition failed due to an internal error: {e}'}))
+    finally:
+        STREAM_CONNECTIONS.dec()
+
+@app.route('/enroll_bulk', methods=['POST'])
+def enroll_bulk():
+    """
+    Registers many people at once, from a zip/tar archive uploaded as multipart file 'archive',
+    or from a directory on the server given as 'directory' (JSON or form field, relative to
+    ENROLL_ROOT), e.g. 'faces'. Photos are named after the person (faces/Akash.jpg) or kept in
+    one folder per person (faces/Akash/1.jpg, ...).
+    Optional 'templates': 'mean' (average each person's photos into one encoding) or 'multi'
+    (keep every photo's encoding); defaults to ENROLL_TEMPLATES.
+    Optional 'strip_root' (archives only, default true): removes a single top-level folder,
+    as in a zipped faces/ directory; false when that folder is one person's photos.
+    Photos are encoded in the worker pool and cached by content hash, so unchanged photos are
+    never encoded twice. Streams newline-delimited JSON: one event per photo with its status
+    ('encoded', 'cached' or 'error') and progress, then a final 'done' summary.
+    """
+    if request.mimetype == 'multipart/form-data':
+        fields = request.form
+    else:
+        fields = request.get_json(silent=True) or {}
+    templates = fields.get('templates') or ENROLL_TEMPLATES
+    if templates not in TEMPLATE_MODES:
+        return jsonify({'success': False, 'message': f"Templates must be one of {', '.join(TEMPLATE_MODES)}."}), 400
+
+    strip_root = str(fields.get('strip_root', True)).lower() not in ('0', 'false', 'no')
+
+    upload = request.files.get('archive')
+    directory = fields.get('directory')
+    # The upload is closed once this view returns, but the response streams for longer.
+    archive = tempfile.TemporaryFile() if upload else None
+    try:
+        if upload:
+            upload.save(archive)
+            images = archive_images(archive, strip_root)
+        elif directory:
+            root = os.path.realpath(ENROLL_ROOT)
+            path = os.path.realpath(os.path.join(root, directory))
+            if os.path.commonpath([root, path]) != root or not os.path.isdir(path):
+                return jsonify({'success': False, 'message': f'Directory not found: {directory}'}), 400
+            images = directory_images(path)
+        else:
+            return jsonify({'success': False, 'message': "An 'archive' upload or a 'directory' is required."}), 400
+        if not images:
+            raise ValueError('No photos found.')
+    except ValueError as e:
+        if archive:
+            archive.close()
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    def generate():
+        try:
+            for event in enroll(images, encoder_pool, encoding_cache, face_gallery.store_templates, templates):
+                yield json.dumps(event) + '\n'
+            print(f"Bulk enrollment finished: {len(images)} photos.")
+        except Exception as e:
+            print(f"Error during bulk enrollment: {e}")
+            yield json.dumps({'event': 'error', 'message': f'Bulk enrollment failed: {e}'}) + '\n'
+        finally:
+            if archive:
+                archive.close()
+
+    return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/delete_user/<name>', methods=['DELETE'])
 def delete_user(name):
     """
-    Deletes a registered user's face encoding and their attendance records from in-memory storage.
+    Deletes a registered user's face encoding and their attendance records from storage.
     """
     try:
-        if name in known_face_encodings:
-            del known_face_encodings[name]
-            print(f"Deleted face encoding for: {name} from memory.")
-        
-        if name in attendance_records:
-            del attendance_records[name]
-            print(f"Deleted attendance records for: {name} from memory.")
+        if face_gallery.remove_person(name):
+            print(f"Deleted face encoding for: {name}.")
+
+        if attendance_writer.delete_user(name):
+            print(f"Deleted attendance records for: {name}.")
 
         return jsonify({'success': True, 'message': f'User {name} and their attendance records deleted.'})
     except Exception as e:
@@ -196,11 +554,11 @@ def delete_user(name):
 @app.route('/clear_all_attendance', methods=['DELETE'])
 def clear_all_attendance():
     """
-    Deletes all attendance records from in-memory storage.
+    Deletes all attendance records from storage.
     """
     try:
-        attendance_records.clear()
-        print("All attendance records cleared from memory.")
+        attendance_writer.clear()
+        print("All attendance records cleared.")
         return jsonify({'success': True, 'message': 'All attendance records cleared.'})
     except Exception as e:
         print(f"Error clearing all attendance: {e}")
@@ -209,10 +567,12 @@ def clear_all_attendance():
 @app.route('/get_known_faces', methods=['GET'])
 def get_known_faces():
     """
-    Returns a list of names of all registered faces from in-memory storage.
+    Returns a list of names of all registered faces.
     """
     try:
-        return jsonify({'success': True, 'known_faces': list(known_face_encodings.keys())})
+        # dict.fromkeys keeps one entry per person, in registration order
+        names = list(dict.fromkeys(person_name(key) for key in face_gallery.current().names()))
+        return jsonify({'success': True, 'known_faces': names})
     except Exception as e:
         print(f"Error fetching known faces: {e}")
         return jsonify({'success': False, 'message': f'Failed to fetch known faces: {e}'}), 500
@@ -220,16 +580,75 @@ def get_known_faces():
 @app.route('/get_attendance', methods=['GET'])
 def get_attendance():
     """
-    Returns the current attendance records with timestamps and types from in-memory storage.
-    The structure will be { "name": [{"timestamp": "iso_string", "type": "check-in/out"}, ...] }.
+    Returns attendance records with timestamps and types.
+    Without query parameters, returns the full history as
+    { "name": [{"timestamp": "iso_string", "type": "check-in/out"}, ...] }.
+    Optional query parameters:
+      name, start, end (YYYY-MM-DD, inclusive) - filter by user and/or date range,
+        returned as a flat 'events' list in recording order.
+      limit, cursor - paginate filtered events; pass back 'next_cursor' for the next page.
+      since - a 'version' from an earlier response: returns only events recorded after it
+        (304 if there are none), or 'reset' with the full history if it is no longer valid.
+    Every response carries its version as the ETag, so If-None-Match returns 304 when nothing changed.
     """
+    args = request.args
+    name = args.get('name')
+    start = args.get('start')
+    end = args.get('end')
+    since = args.get('since')
+    cursor = args.get('cursor')
+    try:
+        limit = int(args['limit']) if 'limit' in args else None
+        for date in (start, end):
+            if date is not None:
+                datetime.date.fromisoformat(date)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must be YYYY-MM-DD and limit a number.'}), 400
+
     try:
-        # Return a copy to prevent external modification of the original dictionary
-        return jsonify({'success': True, 'attendance': attendance_records.copy()})
+        # An immutable snapshot: consistent for the whole request without holding any lock
+        attendance = attendance_writer.current()
+        version = attendance.version
+        if request.if_none_match.contains(version):
+            return not_modified(version)
+
+        if since is not None:
+            after = attendance.parse_token(since)
+            if after is None: # Stale or foreign version: client must start over
+                payload = {'reset': True, 'attendance': attendance.to_dict()}
+            else:
+                events = attendance.query(name, start, end, after=after)
+                if not events:
+                    return not_modified(version)
+                payload = {'reset': False, 'events': [event_json(e) for e in events]}
+        elif name is not None or start or end or limit is not None or cursor:
+            after = 0
+            if cursor:
+                after = attendance.parse_token(cursor)
+                if after is None:
+                    return jsonify({'success': False, 'message': 'Cursor is invalid or expired.'}), 400
+            limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+            events = attendance.query(name, start, end, after=after, limit=limit + 1)
+            next_cursor = attendance.token(events[limit - 1]['seq']) if len(events) > limit else None
+            payload = {'events': [event_json(e) for e in events[:limit]], 'next_cursor': next_cursor}
+        else:
+            payload = {'attendance': attendance.to_dict()}
+
+        response = jsonify({'success': True, 'version': version, **payload})
+        response.set_etag(version)
+        return response
     except Exception as e:
         print(f"Error fetching attendance: {e}")
         return jsonify({'success': False, 'message': f'Failed to fetch attendance: {e}'}), 500
 
+# With debug=True, `python app.py` also imports this module in the reloader's watcher
+# process, which serves nothing; only the child it starts (WERKZEUG_RUN_MAIN set) loads
+# state. The encoder pool starts with the first /recognize_batch request.
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN'):
+    attendance_writer.start()
+    load_state()
+    threading.Thread(target=maintain_stores, daemon=True).start()
+
 # Run the Flask app
 if __name__ == '__main__':
     # Run on all available interfaces and port 5000
@@ -0,0 +1,229 @@
+import bisect
+import copy
+import heapq
+
+
+class AttendanceIndex:
+    """
+    In-memory attendance history indexed for the API:
+    per user, per day and per (user, day), so today's check-in/check-out decision is O(1)
+    and date-range / per-user queries touch only the matching events.
+
+    Every event gets a sequence number in log order. Versions are tokens of the form
+    "<epoch>.<generation>.<seq>": epoch changes when the log files are compacted and
+    generation when history is deleted or cleared, so a token from a client only
+    supports a delta ("what came after seq") while both still match. Every worker
+    process replays the same log in the same order, so they hand out the same tokens.
+
+    snapshot() returns a read-only copy for other threads. Event lists are append-only
+    and shared with snapshots, which ignore events newer than their own seq; the
+    top-level dictionaries and date list are copied before the next change that adds
+    or removes a key, each day's per-user map only before that day gains or loses a
+    user, and deletions build new lists instead of editing shared ones. A new user or
+    day costs a copy proportional to the users or days, never to users x days.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, epoch=0):
+        self.epoch = epoch
+        self.generation = 0
+        self.seq = 0
+        self._events = [] # All events in sequence order
+        self._seqs = [] # Parallel sequence numbers, for bisecting
+        self._by_user = {} # { "name": [event, ...] }
+        self._by_date = {} # { "YYYY-MM-DD": [event, ...] }
+        self._by_date_user = {} # { "YYYY-MM-DD": { "name": [event, ...] } }
+        self._dates = [] # Sorted keys of _by_date
+        self._dump = None # Cached to_dict() result for the current version
+        self._shared = False # Top-level dictionaries and _dates are shared with a snapshot
+        self._owned = set() # Days whose per-user map is not shared with any snapshot
+
+    @property
+    def version(self):
+        return f"{self.epoch}.{self.generation}.{self.seq}"
+
+    def parse_token(self, token):
+        """
+        Returns the sequence number in a version/cursor token, or None if the token
+        is malformed or belongs to a different epoch or generation.
+        """
+        try:
+            epoch, generation, seq = (int(part) for part in token.split('.'))
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or generation != self.generation or seq > self.seq:
+            return None
+        return seq
+
+    def token(self, seq):
+        return f"{self.epoch}.{self.generation}.{seq}"
+
+    def __len__(self):
+        return bisect.bisect_right(self._seqs, self.seq)
+
+    def __contains__(self, name):
+        return name in self._by_user
+
+    def names(self):
+        return list(self._by_user)
+
+    def snapshot(self):
+        """
+        Returns a read-only copy of the index as it is now. Taking one is O(1).
+        """
+        view = copy.copy(self)
+        self._shared = True
+        self._owned = set()
+        return view
+
+    def apply(self, events):
+        """
+        Applies attendance log events (name, iso_timestamp, type) in order.
+        'deleted' drops a user's history and 'cleared' drops everyone's.
+        """
+        for name, timestamp, action_type in events:
+            self.seq += 1
+            if action_type == 'cleared':
+                self._clear()
+            elif action_type == 'deleted':
+                self._remove_user(name)
+            else:
+                self._append(name, timestamp, action_type)
+
+    def last_entry(self, name, date):
+        """
+        Returns the user's last event on a date ('YYYY-MM-DD'), or None.
+        """
+        entries = self._by_date_user.get(date, {}).get(name)
+        if not entries:
+            return None
+        end = self._first_after(entries, self.seq)
+        return entries[end - 1] if end else None
+
+    def to_dict(self):
+        """
+        Full history as { "name": [{"timestamp": "iso_string", "type": "check-in/out"}, ...] }.
+        Cached until the next change.
+        """
+        if self._dump is None or self._dump[0] != self.version:
+            records = {
+                name: [{'timestamp': e['timestamp'], 'type': e['type']}
+                       for e in entries[:self._first_after(entries, self.seq)]]
+                for name, entries in self._by_user.items()
+            }
+            self._dump = (self.version, records)
+        return self._dump[1]
+
+    def query(self, name=None, start=None, end=None, after=0, limit=None):
+        """
+        Returns events with seq > after in sequence order, optionally for one user and/or
+        dates in [start, end] ('YYYY-MM-DD', inclusive). Stops after limit events.
+        """
+        if start is None and end is None:
+            sources = [self._by_user.get(name, [])] if name is not None else [self._events]
+        else:
+            lo = bisect.bisect_left(self._dates, start) if start else 0
+            hi = bisect.bisect_right(self._dates, end) if end else len(self._dates)
+            if name is not None:
+                sources = [self._by_date_user[date].get(name, []) for date in self._dates[lo:hi]]
+            else:
+                sources = [self._by_date[date] for date in self._dates[lo:hi]]
+
+        # Events past self.seq were appended after this snapshot was taken.
+        streams = [entries[self._first_after(entries, after):self._first_after(entries, self.seq)]
+                   for entries in sources if entries]
+        streams = [stream for stream in streams if stream]
+        if not streams:
+            return []
+        merged = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda e: e['seq'])
+        results = []
+        for event in merged:
+            if limit is not None and len(results) >= limit:
+                break
+            results.append(event)
+        return results
+
+    def _first_after(self, entries, after):
+        """
+        Index of the first event with seq > after (entries are in sequence order).
+        """
+        if entries is self._events:
+            return bisect.bisect_right(self._seqs, after)
+        lo, hi = 0, len(entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entries[mid]['seq'] <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _append(self, name, timestamp, action_type):
+        date = timestamp[:10] # ISO timestamps start with YYYY-MM-DD
+        event = {'seq': self.seq, 'name': name, 'timestamp': timestamp, 'type': action_type}
+        self._events.append(event)
+        self._seqs.append(self.seq)
+        if name not in self._by_user:
+            self._unshare()
+            self._by_user[name] = []
+        self._by_user[name].append(event)
+        if date not in self._by_date:
+            self._unshare()
+            self._by_date[date] = []
+            self._by_date_user[date] = {}
+            self._owned.add(date)
+            bisect.insort(self._dates, date)
+        self._by_date[date].append(event)
+        users = self._by_date_user[date]
+        if name not in users:
+            users = self._writable_day(date)
+            users[name] = []
+        users[name].append(event)
+
+    def _remove_user(self, name):
+        self._unshare()
+        entries = self._by_user.pop(name, None)
+        self.generation += 1
+        if not entries:
+            return
+        self._events = [e for e in self._events if e['name'] != name]
+        self._seqs = [e['seq'] for e in self._events]
+        for date in {e['timestamp'][:10] for e in entries}:
+            remaining = [e for e in self._by_date[date] if e['name'] != name]
+            if remaining:
+                self._by_date[date] = remaining
+                del self._writable_day(date)[name]
+            else:
+                del self._by_date[date]
+                del self._by_date_user[date]
+                self._owned.discard(date)
+                self._dates.remove(date)
+
+    def _unshare(self):
+        """
+        Gives the index its own dictionaries and date list before it adds or removes
+        keys, if a snapshot still uses them.
+        """
+        if self._shared:
+            self._by_user = dict(self._by_user)
+            self._by_date = dict(self._by_date)
+            self._by_date_user = dict(self._by_date_user)
+            self._dates = list(self._dates)
+            self._shared = False
+
+    def _writable_day(self, date):
+        """
+        Returns a day's per-user map for changing, copying it first if a snapshot shares it.
+        """
+        if date not in self._owned:
+            self._unshare()
+            self._by_date_user[date] = dict(self._by_date_user[date])
+            self._owned.add(date)
+        return self._by_date_user[date]
+
+    def _clear(self):
+        epoch, generation, seq = self.epoch, self.generation, self.seq
+        self.reset(epoch)
+        self.generation, self.seq = generation + 1, seq
@@ -0,0 +1,209 @@
+"""
+Offline load generator for the Flask app: drives the endpoints in-process through the
+test client (no network), with synthetic faces and a synthetic gallery of configurable
+size, and reports p50/p95/p99 request latency plus per-stage latency taken from the
+Server-Timing header. Use --json to save the numbers and compare them across releases.
+
+Probe images are jittered copies (brightness, shift, mirror) of a real face photo,
+which is registered alongside the synthetic gallery so recognitions succeed.
+recognize_during_writes recognizes while another thread keeps registering and
+deleting a user, to check that admin writes don't stall recognition.
+
+Usage (from backend/):
+    python benchmarks/bench_app.py --gallery-size 10000 --requests 200 --concurrency 4
+    python benchmarks/bench_app.py --scenarios recognize_jpeg get_attendance_since --json results.json
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+SCENARIOS = ['recognize_jpeg', 'recognize_base64', 'recognize_batch', 'get_attendance', 'get_attendance_since',
+             'recognize_during_writes']
+
+
+def synthetic_faces(photo_path, count, rng, width=640, height=480):
+    """
+    JPEG frames with the face photo placed on a grey background, each with random
+    brightness, position and mirroring.
+    """
+    photo = cv2.imread(photo_path, cv2.IMREAD_COLOR)
+    if photo is None:
+        sys.exit(f"Cannot read {photo_path}")
+    scale = min(1.0, 0.8 * height / photo.shape[0], 0.8 * width / photo.shape[1])
+    photo = cv2.resize(photo, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    frames = []
+    for _ in range(count):
+        face = cv2.convertScaleAbs(photo, alpha=rng.uniform(0.8, 1.2), beta=rng.uniform(-20, 20))
+        if rng.random() < 0.5:
+            face = cv2.flip(face, 1)
+        frame = np.full((height, width, 3), 127, dtype=np.uint8)
+        top = int(rng.integers(0, height - face.shape[0] + 1))
+        left = int(rng.integers(0, width - face.shape[1] + 1))
+        frame[top:top + face.shape[0], left:left + face.shape[1]] = face
+        frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes())
+    return frames
+
+
+def parse_server_timing(header):
+    timings = {}
+    for part in filter(None, (p.strip() for p in (header or '').split(','))):
+        name, _, duration = part.partition(';dur=')
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'count': len(samples)}
+
+
+def make_request(client, scenario, frames, index, version):
+    frame = frames[index % len(frames)]
+    if scenario in ('recognize_jpeg', 'recognize_during_writes'):
+        return client.post('/recognize_face', data=frame, content_type='image/jpeg')
+    if scenario == 'recognize_base64':
+        data_url = 'data:image/jpeg;base64,' + base64.b64encode(frame).decode()
+        return client.post('/recognize_face', json={'image': data_url})
+    if scenario == 'recognize_batch':
+        batch = [base64.b64encode(frames[(index + i) % len(frames)]).decode() for i in range(4)]
+        return client.post('/recognize_batch', json={'images': batch})
+    if scenario == 'get_attendance':
+        return client.get('/get_attendance')
+    if scenario == 'get_attendance_since':
+        return client.get(f'/get_attendance?since={version}')
+    raise ValueError(scenario)
+
+
+def run_scenario(app_module, scenario, frames, requests, concurrency):
+    version = app_module.attendance_writer.current().version
+    latencies, stages, statuses = [], {}, {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    finished = threading.Event()
+    admin_writes = []
+
+    def admin():
+        client = app_module.app.test_client()
+        while not finished.is_set():
+            client.post('/register_face?name=benchmark_admin', data=frames[-1], content_type='image/jpeg')
+            client.delete('/delete_user/benchmark_admin')
+            admin_writes.append(2)
+
+    def worker():
+        client = app_module.app.test_client()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            response = make_request(client, scenario, frames, index, version)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                for name, duration in parse_server_timing(response.headers.get('Server-Timing')).items():
+                    stages.setdefault(name, []).append(duration)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    admin_thread = threading.Thread(target=admin) if scenario == 'recognize_during_writes' else None
+    for thread in threads:
+        thread.start()
+    if admin_thread:
+        admin_thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    finished.set()
+    if admin_thread:
+        admin_thread.join()
+    return {
+        'admin_writes': sum(admin_writes),
+        'latency_ms': percentiles(latencies),
+        'throughput_rps': requests / wall,
+        'statuses': {str(code): n for code, n in sorted(statuses.items())},
+        'stages_ms': {name: percentiles(samples) for name, samples in sorted(stages.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photo', default=os.path.join(BACKEND_DIR, 'faces', 'Akash.jpg'))
+    parser.add_argument('--gallery-size', type=int, default=10000)
+    parser.add_argument('--attendance-events', type=int, default=10000, help='synthetic history to preload')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--probes', type=int, default=20, help='distinct synthetic probe frames')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    # Everything goes to a throwaway directory; timing headers feed the per-stage numbers.
+    data_dir = tempfile.mkdtemp(prefix='facetrack-bench-')
+    os.environ['EMBEDDINGS_DIR'] = os.path.join(data_dir, 'embeddings')
+    os.environ['ATTENDANCE_LOG_DIR'] = os.path.join(data_dir, 'attendance_logs')
+    os.environ['TIMING_HEADER'] = '1'
+    os.environ.setdefault('RECOGNITION_WORKERS', str(max(1, args.concurrency)))
+    import app as app_module
+
+    rng = np.random.default_rng(args.seed)
+    frames = synthetic_faces(args.photo, args.probes, rng)
+
+    gallery = rng.standard_normal((args.gallery_size, 128)).astype(np.float32)
+    gallery /= np.linalg.norm(gallery, axis=1, keepdims=True)
+    with app_module.face_gallery.writing() as store:
+        store.add_many([f'synthetic_{i}' for i in range(args.gallery_size)], gallery)
+    now = time.time()
+    for i in range(args.attendance_events):
+        stamp = datetime.datetime.fromtimestamp(now - (args.attendance_events - i) * 60)
+        app_module.attendance_log.append(f'synthetic_{i % max(1, args.gallery_size)}', stamp, 'check-in')
+    app_module.load_state() # sync_state() only reads the latest day and today, not the older history
+
+
+    client = app_module.app.test_client()
+    registered = client.post('/register_face?name=benchmark_face', data=frames[0], content_type='image/jpeg')
+    if not registered.json.get('success'):
+        print(f"warning: benchmark face was not registered ({registered.json.get('message')})")
+
+    results = {
+        'config': {k: v for k, v in vars(args).items() if k != 'json'},
+        'gallery_size': len(app_module.face_gallery.current()),
+        'attendance_size': len(app_module.attendance_writer.current()),
+        'scenarios': {},
+    }
+    for scenario in args.scenarios:
+        result = run_scenario(app_module, scenario, frames, args.requests, args.concurrency)
+        results['scenarios'][scenario] = result
+        latency = result['latency_ms']
+        print(f"{scenario:<22} p50 {latency['p50']:8.2f}  p95 {latency['p95']:8.2f}  p99 {latency['p99']:8.2f} ms"
+              f"  {result['throughput_rps']:8.1f} req/s  statuses {result['statuses']}"
+              + (f"  admin writes {result['admin_writes']}" if result['admin_writes'] else ''))
+        for name, stats in result['stages_ms'].items():
+            print(f"    {name:<18} p50 {stats['p50']:8.3f}  p95 {stats['p95']:8.3f}  p99 {stats['p99']:8.3f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+        print(f"results written to {args.json}")
+    app_module.encoder_pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmarks the gallery search backends on synthetic 128-d face embeddings.
+
+Reports recall@1 of the approximate (IVF / IVF-PQ) backends against exact search,
+p50/p99 query latency and memory held by the stored encodings.
+
+Usage (from backend/):
+    python benchmarks/bench_gallery.py --sizes 10000 100000 1000000 --queries 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import ENCODING_SIZE, FaceGallery # noqa: E402
+from ivf import IVFGallery # noqa: E402
+
+# Faces registered between maintenance passes while the benchmark grows an index.
+GROWTH_BATCH = 10000
+
+
+def synthetic_embeddings(n, rng, groups=1024, group_spread=0.03, identity_spread=0.045):
+    """
+    Embeddings drawn around overlapping group centres, spread so that, like dlib
+    embeddings, different people are about 0.6-0.7 apart at their closest. The groups
+    give the coarse quantizer some structure without making the cells clean clusters.
+    """
+    centres = group_spread * rng.standard_normal((groups, ENCODING_SIZE)).astype(np.float32)
+    jitter = identity_spread * rng.standard_normal((n, ENCODING_SIZE)).astype(np.float32)
+    return centres[rng.integers(0, groups, n)] + jitter
+
+
+def synthetic_probes(gallery_data, count, rng, noise=0.4):
+    """
+    Probes are perturbed copies of enrolled faces, like a new photo of a registered
+    person: 0.4 from their enrolled encoding, close to the distance to other people.
+    """
+    rows = rng.integers(0, len(gallery_data), count)
+    jitter = rng.standard_normal((count, ENCODING_SIZE)).astype(np.float32)
+    jitter *= noise / np.linalg.norm(jitter, axis=1, keepdims=True)
+    return gallery_data[rows] + jitter
+
+
+def run_queries(gallery, probes):
+    latencies = np.empty(len(probes))
+    answers = []
+    for i, probe in enumerate(probes):
+        start = time.perf_counter()
+        name, _ = gallery.best_match(probe, tolerance=np.inf)
+        latencies[i] = time.perf_counter() - start
+        answers.append(name)
+    return answers, latencies
+
+
+def report(label, answers, latencies, truth, memory):
+    recall = np.mean([a == t for a, t in zip(answers, truth)])
+    p50, p99 = np.percentile(latencies * 1e3, [50, 99])
+    print(f"  {label:<22} recall@1={recall:6.3f}  p50={p50:8.3f} ms  p99={p99:8.3f} ms  memory={memory / 2**20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--pq-m', type=int, default=16, help='PQ bytes per face (0 disables the IVF-PQ runs)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for size in args.sizes:
+        data = synthetic_embeddings(size, rng)
+        names = [f"user_{i}" for i in range(size)]
+        probes = synthetic_probes(data, args.queries, rng)
+        print(f"gallery size {size}")
+
+        exact = FaceGallery()
+        exact.add_many(names, data)
+        truth, latencies = run_queries(exact, probes)
+        report('exact', truth, latencies, truth, size * (ENCODING_SIZE + 1) * 4)
+
+        variants = [('ivf', 0)] + ([('ivf-pq%d' % args.pq_m, args.pq_m)] if args.pq_m else [])
+        for label, pq_m in variants:
+            # Grown the way the app grows it: trained at the default train_size, then
+            # re-trained whenever it outgrows that (GalleryState.maintain()).
+            start = time.perf_counter()
+            index = IVFGallery(pq_m=pq_m)
+            rebuilds = 0
+            for batch in range(0, size, GROWTH_BATCH):
+                end = min(size, batch + GROWTH_BATCH)
+                index.add_many(names[batch:end], data[batch:end])
+                if index.needs_rebuild:
+                    index.rebuild(names[:end], data[:end])
+                    rebuilds += 1
+            build = time.perf_counter() - start
+            print(f"  {label} build: {build:.1f} s, nlist={len(index._lists)}, rebuilds={rebuilds}")
+            for nprobe in args.nprobe:
+                index.nprobe = nprobe
+                answers, latencies = run_queries(index, probes)
+                report(f"{label} nprobe={nprobe}", answers, latencies, truth, index.memory_bytes())
+
+
+if __name__ == '__main__':
+    main()
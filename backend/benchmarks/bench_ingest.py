@@ -0,0 +1,98 @@
+"""
+Benchmarks the image ingest path: payload size on the wire and the latency of each
+decode / detect / encode stage, for the old base64 PNG path and the binary JPEG/WebP
+path with reduced-resolution decode and downscale-before-detect.
+
+A webcam-sized frame is synthesized from a face photo (backend/faces/*.jpg by default).
+
+Usage (from backend/):
+    python benchmarks/bench_ingest.py --width 1280 --height 720 --repeats 20
+"""
+import argparse
+import base64
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import face_recognition
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from imaging import decode_bytes, locate_faces # noqa: E402
+
+
+def make_frame(photo_path, width, height):
+    """
+    Places the face photo in the middle of a grey frame of the given size, like a kiosk camera shot.
+    """
+    photo = cv2.imread(photo_path, cv2.IMREAD_COLOR)
+    if photo is None:
+        sys.exit(f"Cannot read {photo_path}")
+    scale = min(1.0, 0.8 * height / photo.shape[0], 0.8 * width / photo.shape[1])
+    photo = cv2.resize(photo, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    frame = np.full((height, width, 3), 127, dtype=np.uint8)
+    top = (height - photo.shape[0]) // 2
+    left = (width - photo.shape[1]) // 2
+    frame[top:top + photo.shape[0], left:left + photo.shape[1]] = photo
+    return frame
+
+
+def timed(fn, repeats):
+    """
+    Runs fn repeats times; returns (last result, median milliseconds).
+    """
+    samples = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1e3)
+    return result, statistics.median(samples)
+
+
+def run_pipeline(label, payload, decode, reduction, detect_max_width, repeats):
+    image_bytes, t_b64 = timed(lambda: decode(payload), repeats)
+    image, t_decode = timed(lambda: decode_bytes(image_bytes, reduction), repeats)
+    rgb, t_convert = timed(lambda: cv2.cvtColor(image, cv2.COLOR_BGR2RGB), repeats)
+    locations, t_detect = timed(lambda: locate_faces(rgb, detect_max_width), repeats)
+    _, t_encode = timed(lambda: face_recognition.face_encodings(rgb, locations), repeats)
+    total = t_b64 + t_decode + t_convert + t_detect + t_encode
+    print(f"{label:<34} {len(payload) / 1024:9.1f} KiB  {image.shape[1]:>5}x{image.shape[0]:<5}"
+          f" b64 {t_b64:6.2f}  decode {t_decode:6.2f}  cvtColor {t_convert:5.2f}"
+          f"  detect {t_detect:7.2f}  encode {t_encode:6.2f}  total {total:7.2f} ms  faces={len(locations)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image', default=os.path.join(BACKEND_DIR, 'faces', 'Akash.jpg'))
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--detect-max-width', type=int, default=640)
+    args = parser.parse_args()
+
+    frame = make_frame(args.image, args.width, args.height)
+    png_data_url = 'data:image/png;base64,' + base64.b64encode(cv2.imencode('.png', frame)[1]).decode()
+    jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+    webp = cv2.imencode('.webp', frame, [cv2.IMWRITE_WEBP_QUALITY, 90])[1].tobytes()
+
+    def from_data_url(payload):
+        return base64.b64decode(payload.split(',')[1])
+
+    def raw(payload):
+        return payload
+
+    print(f"frame {args.width}x{args.height}, median of {args.repeats} runs per stage")
+    run_pipeline('before: base64 PNG, full detect', png_data_url, from_data_url, 1, 0, args.repeats)
+    run_pipeline('raw JPEG, full detect', jpeg, raw, 1, 0, args.repeats)
+    run_pipeline('raw WebP, full detect', webp, raw, 1, 0, args.repeats)
+    run_pipeline(f'raw JPEG, detect at {args.detect_max_width}px', jpeg, raw, 1, args.detect_max_width, args.repeats)
+    run_pipeline('raw JPEG, 1/2 decode', jpeg, raw, 2, args.detect_max_width, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
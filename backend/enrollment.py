@@ -0,0 +1,283 @@
+"""
+Bulk enrollment: registers everyone in a directory of photos or a zip/tar archive.
+
+Photos are named after the person (faces/Akash.jpg), or grouped in one folder per
+person (faces/Akash/front.jpg, faces/Akash/side.jpg) to give someone several
+reference photos. Detection and encoding run in parallel in an EncoderPool, and every
+result is kept in an EncodingCache, so photos that were imported before are not
+encoded again.
+
+Archives may hold that layout at their top level or inside one wrapping folder, as
+zipping faces/ produces; a single top-level folder is removed by default. For an
+archive of one person's folder (Akash/1.jpg, Akash/2.jpg) pass --keep-root.
+
+Used by the /enroll_bulk endpoint and as a command-line tool (from backend/):
+    python enrollment.py faces/
+    python enrollment.py photos.zip --templates multi --workers 8
+The running app picks up the new encodings from the shared embedding store.
+"""
+import argparse
+import functools
+import os
+import posixpath
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+
+from gallery import TEMPLATE_SEPARATOR
+from workers import PoolSaturated
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+# How a person with several photos is stored: one averaged encoding ('mean'),
+# or every encoding as its own template, matched by the closest one ('multi').
+TEMPLATE_MODES = ('mean', 'multi')
+
+
+def _is_image(path):
+    filename = posixpath.basename(path)
+    return not filename.startswith('.') and filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _label(paths, strip_root=False):
+    """
+    Pairs each relative path ('/'-separated) with the person it shows: the folder it is
+    in, or the file name for photos at the top level. With strip_root, a single folder
+    holding everything (faces.zip -> faces/Akash.jpg, faces/Bob/1.jpg) is removed first.
+    """
+    parts = [path.split('/') for path in paths]
+    roots = {p[0] for p in parts}
+    if strip_root and len(roots) == 1 and all(len(p) > 1 for p in parts):
+        parts = [p[1:] for p in parts]
+    labelled = []
+    for path, p in zip(paths, parts):
+        name = p[-2] if len(p) > 1 else posixpath.splitext(p[-1])[0]
+        labelled.append((path, name.replace(TEMPLATE_SEPARATOR, '')))
+    return labelled
+
+
+def directory_images(root):
+    """
+    Lists the photos under a directory as [(path, name, read), ...], where read()
+    returns the image bytes.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        for filename in sorted(filenames):
+            path = filename if relative == '.' else f"{relative}/{filename}"
+            if _is_image(path):
+                paths.append(path)
+
+    def reader(path):
+        def read():
+            with open(os.path.join(root, *path.split('/')), 'rb') as image:
+                return image.read()
+        return read
+
+    return [(path, name, reader(path)) for path, name in _label(paths)]
+
+
+def archive_images(fileobj, strip_root=True):
+    """
+    Lists the photos in a zip or tar archive (any file object that can seek) like
+    directory_images(). Members are read from the archive directly, never extracted.
+    With strip_root (the default), a single top-level folder is taken to wrap the whole
+    layout, as when a directory is zipped; without it, it is a person's folder.
+    Raises ValueError if it is not a zip or tar archive.
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        archive = zipfile.ZipFile(fileobj)
+        paths = [info.filename for info in archive.infolist()
+                 if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+        read_member = archive.read
+    else:
+        fileobj.seek(0)
+        try:
+            archive = tarfile.open(fileobj=fileobj)
+        except tarfile.TarError:
+            raise ValueError('Archive must be a zip or tar file.')
+        members = {member.name: member for member in archive.getmembers() if member.isfile()}
+        paths = list(members)
+
+        def read_member(path):
+            return archive.extractfile(members[path]).read()
+
+    paths = sorted(path for path in paths if _is_image(path))
+    return [(path, name, lambda path=path: read_member(path)) for path, name in _label(paths, strip_root)]
+
+
+def largest_face(faces):
+    """
+    Encoding of the biggest face among [((top, right, bottom, left), encoding), ...],
+    so a bystander in the background of a portrait is not enrolled. None if there are none.
+    """
+    if not faces:
+        return None
+    _, encoding = max(
+        faces, key=lambda face: (face[0][2] - face[0][0]) * (face[0][1] - face[0][3]))
+    return np.asarray(encoding, dtype=np.float32)
+
+
+def enroll(images, pool, cache, save, templates='mean'):
+    """
+    Encodes every photo and stores each person's reference encodings.
+    images is a list from directory_images() / archive_images(), and save(templates) stores
+    { "name": [encoding, ...] }, e.g. with gallery.store_templates(). Photos already in the
+    cache are not encoded again; the rest go through the pool, at most two per worker
+    at a time so /recognize_batch keeps getting room in its queue.
+
+    Yields one event per photo as it finishes (in completion order),
+        {'event': 'image', 'path', 'name', 'status': 'encoded' | 'cached' | 'error', 'error', 'done', 'total'}
+    and finally {'event': 'done', 'images', 'encoded', 'cached', 'failed', 'people', 'templates', 'seconds'}.
+    Nothing is saved until every photo has been processed.
+    """
+    if templates not in TEMPLATE_MODES:
+        raise ValueError(f"Templates must be one of {', '.join(TEMPLATE_MODES)}.")
+    start = time.perf_counter()
+    total = len(images)
+    counts = {'encoded': 0, 'cached': 0, 'error': 0}
+    found = {} # Maps { "name": [(path, encoding), ...] }
+    window = pool.workers * 2
+    cache.refresh()
+
+    def finished(path, name, status, encoding=None, error=None):
+        if encoding is not None:
+            found.setdefault(name, []).append((path, encoding))
+        elif status != 'error':
+            status = 'error'
+        counts[status] += 1
+        return {'event': 'image', 'path': path, 'name': name, 'status': status, 'error': error,
+                'done': sum(counts.values()), 'total': total}
+
+    queue = iter(images)
+    held = None # A photo the pool had no room for, with its bytes and cache key
+    pending = {} # Maps { future: (path, name, cache key) }
+    exhausted = False
+    while not exhausted or held or pending:
+        while (held or not exhausted) and len(pending) < window:
+            if held:
+                path, name, image_bytes, key = held
+                held = None
+            else:
+                entry = next(queue, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                path, name, read = entry
+                try:
+                    image_bytes = read()
+                except Exception as e:
+                    yield finished(path, name, 'error', error=f'Could not read image: {e}')
+                    continue
+                key = cache.key(image_bytes, pool.reduction, pool.detect_max_width)
+                hit = cache.get(key)
+                if hit is not None:
+                    encoding, error = hit
+                    yield finished(path, name, 'cached', encoding, error)
+                    continue
+            try:
+                future, = pool.submit_many([image_bytes])
+            except PoolSaturated: # Recognition requests fill the queue; retry once something finishes
+                held = (path, name, image_bytes, key)
+                break
+            pending[future] = (path, name, key)
+
+        if not pending:
+            if held:
+                time.sleep(0.05)
+            continue
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            path, name, key = pending.pop(future)
+            try:
+                encoding = largest_face(future.result())
+            except ValueError as e: # Not a readable image
+                cache.put(key, None, str(e))
+                yield finished(path, name, 'error', error=str(e))
+                continue
+            except Exception as e: # Worker died; not cached so the next run retries it
+                yield finished(path, name, 'error', error=f'Encoding failed: {e}')
+                continue
+            error = None if encoding is not None else 'No face detected in the image.'
+            cache.put(key, encoding, error)
+            yield finished(path, name, 'encoded', encoding, error)
+
+    people = {}
+    for name, photos in sorted(found.items()):
+        encodings = [encoding for _, encoding in sorted(photos, key=lambda photo: photo[0])]
+        if templates == 'mean':
+            encodings = [np.mean(encodings, axis=0)]
+        people[name] = encodings
+    save(people)
+
+    yield {
+        'event': 'done',
+        'images': total,
+        'encoded': counts['encoded'],
+        'cached': counts['cached'],
+        'failed': counts['error'],
+        'people': len(people),
+        'templates': sum(len(encodings) for encodings in people.values()),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def main():
+    from gallery import store_templates
+    from imaging import DECODE_REDUCTIONS
+    from storage import EmbeddingStore, EncodingCache
+    from workers import EncoderPool
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    embeddings_dir = os.environ.get('EMBEDDINGS_DIR', os.path.join(base_dir, 'embeddings'))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='directory of photos, or a .zip / .tar(.gz) archive')
+    parser.add_argument('--keep-root', action='store_true',
+                        help="archives only: a single top-level folder is a person's folder, not a wrapper")
+    parser.add_argument('--templates', choices=TEMPLATE_MODES, default=os.environ.get('ENROLL_TEMPLATES', 'mean'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('RECOGNITION_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--embeddings-dir', default=embeddings_dir)
+    parser.add_argument('--cache-dir', default=os.environ.get('ENCODING_CACHE_DIR', os.path.join(embeddings_dir, 'cache')))
+    # Same defaults as the app, so the CLI and /enroll_bulk share cache entries.
+    parser.add_argument('--reduction', type=int, choices=DECODE_REDUCTIONS, default=int(os.environ.get('DECODE_REDUCTION', 1)))
+    parser.add_argument('--detect-max-width', type=int, default=int(os.environ.get('DETECT_MAX_WIDTH', 640)))
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        images = directory_images(args.source)
+    else:
+        try:
+            images = archive_images(open(args.source, 'rb'), strip_root=not args.keep_root)
+        except (OSError, ValueError) as e:
+            sys.exit(f"Cannot read {args.source}: {e}")
+    if not images:
+        sys.exit(f"No photos found in {args.source}.")
+
+    pool = EncoderPool(args.workers, args.workers * 4, reduction=args.reduction, detect_max_width=args.detect_max_width)
+    print(f"Enrolling {len(images)} photos with {pool.workers} workers...")
+    pool.start()
+    try:
+        store = EmbeddingStore(args.embeddings_dir)
+        store.load() # store_templates() looks up each person's existing templates
+        save = functools.partial(store_templates, store)
+        for event in enroll(images, pool, EncodingCache(args.cache_dir), save, args.templates):
+            if event['event'] == 'done':
+                print(f"Enrolled {event['people']} people ({event['templates']} templates) from {event['images']} photos "
+                      f"in {event['seconds']}s: {event['encoded']} encoded, {event['cached']} cached, {event['failed']} failed.")
+            elif event['status'] == 'error':
+                print(f"  {event['path']}: {event['error']}")
+            elif event['done'] % 100 == 0 or event['done'] == event['total']:
+                print(f"  {event['done']}/{event['total']}")
+    finally:
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
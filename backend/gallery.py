@@ -0,0 +1,279 @@
+import copy
+
+import numpy as np
+
+# Length of the face embeddings produced by face_recognition / dlib.
+ENCODING_SIZE = 128
+
+# Default match tolerance, same value face_recognition.compare_faces uses.
+DEFAULT_TOLERANCE = 0.6
+
+# A person may have several reference encodings (templates). They are stored under
+# separate keys, the bare name for the first and "name<US>1", "name<US>2", ... for the
+# rest, with the ASCII unit separator that can't appear in a name typed into the UI.
+TEMPLATE_SEPARATOR = '\x1f'
+
+# Rows per storage chunk of a FaceGallery. Snapshots share chunks with the gallery,
+# so a change after a snapshot copies only the chunks it touches (8 MiB each).
+CHUNK_ROWS = 16384
+
+
+class FaceGallery:
+    """
+    Keeps every registered face encoding in contiguous float32 (rows x 128) chunks
+    with a parallel array of names, so a probe is answered by a few batched distance
+    computations instead of a Python loop over every registered user.
+
+    snapshot() returns a read-only copy that any number of threads can search without
+    locking while the gallery keeps changing. Snapshots share storage with the gallery
+    (copy-on-write): after one is taken, the gallery copies its name list and index
+    before the next change, and each chunk before it first writes to it.
+    """
+
+    # An exact scan has no clustering to outgrow (see IVFGallery.needs_rebuild).
+    needs_rebuild = False
+
+    def __init__(self, chunk_rows=CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self._chunks = [] # (chunk_rows x 128) float32 blocks
+        # Squared L2 norm of every row, kept alongside so distances are one matmul per chunk.
+        self._chunk_norms = []
+        self._names = []
+        self._index = {} # Maps { "name": row }
+        self._owned = set() # Chunks not shared with any snapshot, writable in place
+        self._shared = False # Names, index and chunk lists are shared with a snapshot
+        self._frozen = False # This is a snapshot
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self):
+        """
+        Returns the registered names in row order.
+        """
+        return list(self._names)
+
+    def encodings(self):
+        """
+        Returns a read-only (N x 128) array of every encoding, in row order.
+        """
+        n = len(self._names)
+        blocks = [self._chunks[c][:n - c * self.chunk_rows] for c in range(-(-n // self.chunk_rows))]
+        matrix = np.concatenate(blocks) if blocks else np.zeros((0, ENCODING_SIZE), dtype=np.float32)
+        matrix.flags.writeable = False
+        return matrix
+
+    def get(self, name):
+        """
+        Returns a copy of the encoding registered for a name, or None.
+        """
+        row = self._index.get(name)
+        if row is None:
+            return None
+        c, i = divmod(row, self.chunk_rows)
+        return self._chunks[c][i].copy()
+
+    def snapshot(self):
+        """
+        Returns a read-only copy of the gallery as it is now. Taking one is O(chunks).
+        """
+        view = copy.copy(self)
+        view._frozen = True
+        view._owned = frozenset()
+        self._shared = True
+        self._owned = set()
+        return view
+
+    def add(self, name, encoding):
+        """
+        Registers (or replaces) the encoding for a name.
+        """
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        self._unshare()
+        row = self._index.get(name)
+        if row is None:
+            row = len(self._names)
+            if row == len(self._chunks) * self.chunk_rows:
+                self._chunks.append(np.zeros((self.chunk_rows, ENCODING_SIZE), dtype=np.float32))
+                self._chunk_norms.append(np.zeros(self.chunk_rows, dtype=np.float32))
+                self._owned.add(len(self._chunks) - 1)
+            self._names.append(name)
+            self._index[name] = row
+        c, i = self._writable(row)
+        self._chunks[c][i] = encoding
+        self._chunk_norms[c][i] = np.dot(encoding, encoding)
+
+    def add_many(self, names, encodings):
+        """
+        Registers (or replaces) many encodings at once. New names are copied in with
+        one slice assignment per chunk, so a full reload from the store stays fast.
+        """
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        self._unshare()
+        new = list(names)
+        added = encodings
+        if not self._index.keys().isdisjoint(new) or len(set(new)) < len(new):
+            positions = {} # Maps { "name": position in encodings }, the last one winning
+            for position, name in enumerate(new):
+                if name in self._index:
+                    self.add(name, encodings[position])
+                else:
+                    positions[name] = position
+            new = list(positions)
+            added = encodings[list(positions.values())]
+        start = len(self._names)
+        self._names.extend(new)
+        self._index.update(zip(new, range(start, start + len(new))))
+        done = 0
+        while done < len(added):
+            row = start + done
+            if row == len(self._chunks) * self.chunk_rows:
+                self._chunks.append(np.zeros((self.chunk_rows, ENCODING_SIZE), dtype=np.float32))
+                self._chunk_norms.append(np.zeros(self.chunk_rows, dtype=np.float32))
+                self._owned.add(len(self._chunks) - 1)
+            c, i = self._writable(row)
+            block = added[done:done + self.chunk_rows - i]
+            self._chunks[c][i:i + len(block)] = block
+            self._chunk_norms[c][i:i + len(block)] = np.einsum('ij,ij->i', block, block)
+            done += len(block)
+
+    def remove(self, name):
+        """
+        Removes a name from the gallery by moving the last row into its slot.
+        Returns True if the name was registered.
+        """
+        self._unshare()
+        row = self._index.pop(name, None)
+        if row is None:
+            return False
+        last = len(self._names) - 1
+        if row != last:
+            last_name = self._names[last]
+            c, i = self._writable(row)
+            lc, li = divmod(last, self.chunk_rows)
+            self._chunks[c][i] = self._chunks[lc][li]
+            self._chunk_norms[c][i] = self._chunk_norms[lc][li]
+            self._names[row] = last_name
+            self._index[last_name] = row
+        self._names.pop()
+        return True
+
+    def clear(self):
+        self._unshare()
+        self._chunks = []
+        self._chunk_norms = []
+        self._names = []
+        self._index = {}
+        self._owned = set()
+
+    def distances(self, encoding):
+        """
+        Returns the Euclidean distance from an encoding to every registered face, in row order.
+        """
+        n = len(self._names)
+        probe = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        probe_sq = np.dot(probe, probe)
+        blocks = []
+        for c in range(-(-n // self.chunk_rows)): # Chunks holding at least one row
+            rows = min(self.chunk_rows, n - c * self.chunk_rows)
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab
+            blocks.append(self._chunk_norms[c][:rows] + probe_sq - 2.0 * (self._chunks[c][:rows] @ probe))
+        if not blocks:
+            return np.zeros(0, dtype=np.float32)
+        sq = np.concatenate(blocks)
+        np.maximum(sq, 0.0, out=sq) # Clip float rounding
+        return np.sqrt(sq)
+
+    def best_match(self, encoding, tolerance=DEFAULT_TOLERANCE):
+        """
+        Finds the closest registered face to an encoding.
+        Returns (name, distance), with name None when nothing is within tolerance.
+        """
+        if not self._names:
+            return None, None
+        distances = self.distances(encoding)
+        row = int(np.argmin(distances))
+        distance = float(distances[row])
+        if distance <= tolerance:
+            return self._names[row], distance
+        return None, distance
+
+    def _unshare(self):
+        """
+        Gives the gallery its own name list, index and chunk lists before it changes
+        them, if a snapshot still uses them.
+        """
+        if self._frozen:
+            raise RuntimeError('Gallery snapshots are read-only.')
+        if self._shared:
+            self._names = list(self._names)
+            self._index = dict(self._index)
+            self._chunks = list(self._chunks)
+            self._chunk_norms = list(self._chunk_norms)
+            self._shared = False
+
+    def _writable(self, row):
+        """
+        Returns (chunk, offset) of a row, copying its chunk first if a snapshot shares it.
+        """
+        c, i = divmod(row, self.chunk_rows)
+        if c not in self._owned:
+            self._chunks[c] = self._chunks[c].copy()
+            self._chunk_norms[c] = self._chunk_norms[c].copy()
+            self._owned.add(c)
+        return c, i
+
+
+def template_key(name, index):
+    """
+    Key of a person's index-th reference encoding; the first one is just the name.
+    """
+    return name if index == 0 else f"{name}{TEMPLATE_SEPARATOR}{index}"
+
+
+def person_name(key):
+    """
+    The person a gallery key belongs to.
+    """
+    return key.split(TEMPLATE_SEPARATOR, 1)[0]
+
+
+def template_keys(keys, name):
+    """
+    Keys of every reference encoding stored for a person, looked up in anything that
+    supports `in` (a gallery or an EmbeddingStore). Templates are numbered without gaps.
+    """
+    found = []
+    while template_key(name, len(found)) in keys:
+        found.append(template_key(name, len(found)))
+    return found
+
+
+def store_templates(store, templates):
+    """
+    Replaces the stored reference encodings of each person in { "name": [encoding, ...] }.
+    Templates beyond the new count are removed, so re-enrolling with fewer photos shrinks them.
+    """
+    keys, encodings = [], []
+    for name, person_encodings in templates.items():
+        for key in template_keys(store, name)[len(person_encodings):]:
+            store.remove(key)
+        keys.extend(template_key(name, i) for i in range(len(person_encodings)))
+        encodings.extend(person_encodings)
+    if keys:
+        store.add_many(keys, encodings)
+
+
+def create_gallery(kind='exact', **options):
+    """
+    Builds the gallery search backend by name: 'exact' (brute force) or 'ivf' (approximate).
+    """
+    if kind == 'exact':
+        return FaceGallery(**options)
+    if kind == 'ivf':
+        from ivf import IVFGallery # Imported here to avoid a circular import
+        return IVFGallery(**options)
+    raise ValueError(f"Unknown gallery backend: {kind}")
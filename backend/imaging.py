@@ -0,0 +1,91 @@
+import cv2
+import face_recognition
+import numpy as np
+
+from metrics import stage
+
+# cv2.imdecode flags that let libjpeg / libwebp decode straight to 1/2, 1/4 or 1/8 size,
+# which is much cheaper than decoding the full frame and resizing it afterwards.
+_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+DECODE_REDUCTIONS = tuple(_DECODE_FLAGS)
+
+
+def decode_bytes(image_bytes, reduction=1):
+    """
+    Decodes encoded image bytes (JPEG/WebP/PNG/...) into a BGR image, optionally at
+    1/2, 1/4 or 1/8 resolution. Returns None if the bytes are not a readable image.
+    """
+    if not image_bytes:
+        return None
+    flag = _DECODE_FLAGS.get(reduction)
+    if flag is None:
+        raise ValueError(f"Decode reduction must be one of {', '.join(map(str, DECODE_REDUCTIONS))}.")
+    with stage('imdecode'):
+        return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), flag)
+
+
+def scale_box(box, factor):
+    """
+    Scales a (top, right, bottom, left) box found in an image decoded at 1/factor
+    resolution back to the coordinates of the uploaded frame.
+    """
+    return tuple(int(v) * factor for v in box)
+
+
+def locate_faces(rgb_image, detect_max_width=0):
+    """
+    Finds face boxes (top, right, bottom, left) in full-resolution coordinates.
+    Frames wider than detect_max_width are shrunk before HOG detection, which is the
+    expensive part; the boxes are scaled back up so encoding still uses every pixel.
+    """
+    height, width = rgb_image.shape[:2]
+    if not detect_max_width or width <= detect_max_width:
+        return face_recognition.face_locations(rgb_image)
+
+    scale = detect_max_width / width
+    small = cv2.resize(rgb_image, (detect_max_width, max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))),
+            max(0, int(left / scale)),
+        )
+        for top, right, bottom, left in face_recognition.face_locations(small)
+    ]
+
+
+def detect_faces(image, detect_max_width=0):
+    """
+    Converts a BGR image to RGB and finds its faces. Returns (rgb_image, face_locations).
+    """
+    # Convert BGR (OpenCV default) to RGB (face_recognition expects RGB)
+    with stage('convert'):
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    with stage('detect'):
+        return rgb_image, locate_faces(rgb_image, detect_max_width)
+
+
+def encode_locations(rgb_image, face_locations):
+    """
+    Computes the 128-d encoding for each given face box, as float32 arrays.
+    """
+    if not face_locations:
+        return []
+    with stage('encode'):
+        return [encoding.astype(np.float32) for encoding in face_recognition.face_encodings(rgb_image, face_locations)]
+
+
+def encode_faces(image, detect_max_width=0):
+    """
+    Detects every face in a BGR image and returns [((top, right, bottom, left), encoding), ...].
+    """
+    rgb_image, face_locations = detect_faces(image, detect_max_width)
+    encodings = encode_locations(rgb_image, face_locations)
+    return [(tuple(int(v) for v in location), encoding)
+            for location, encoding in zip(face_locations, encodings)]
@@ -0,0 +1,385 @@
+import copy
+
+import numpy as np
+
+from gallery import ENCODING_SIZE, DEFAULT_TOLERANCE, FaceGallery
+
+# Number of centroids per product-quantizer subspace (codes fit in a uint8).
+PQ_CENTROIDS = 256
+
+
+def _nearest_centroid(data, centroids, chunk=65536):
+    """
+    Returns the index of the nearest centroid for every row of data, in chunks
+    so the (rows x centroids) distance block stays small.
+    """
+    c_sq = np.einsum('ij,ij->i', centroids, centroids)
+    assign = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], chunk):
+        block = data[start:start + chunk]
+        # ||x||^2 is constant per row, so it can be dropped from the argmin.
+        assign[start:start + chunk] = np.argmin(c_sq - 2.0 * (block @ centroids.T), axis=1)
+    return assign
+
+
+def _kmeans(data, k, iterations, rng):
+    """
+    Plain Lloyd's k-means. Empty clusters are reseeded from random points.
+    """
+    n = data.shape[0]
+    k = min(k, n)
+    centroids = data[rng.choice(n, k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest_centroid(data, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(n, len(empty), replace=False)]
+    return centroids.astype(np.float32)
+
+
+class _InvertedList:
+    """
+    One IVF cell: a growable block of rows (float32 vectors or uint8 PQ codes)
+    with a parallel list of names.
+    """
+
+    def __init__(self, width, dtype):
+        self.data = np.zeros((0, width), dtype=dtype)
+        self.sq_norms = np.zeros(0, dtype=np.float32)
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def copy(self):
+        inverted = copy.copy(self)
+        inverted.data = self.data.copy()
+        inverted.sq_norms = self.sq_norms.copy()
+        inverted.names = list(self.names)
+        return inverted
+
+    def extend(self, rows, sq_norms, names):
+        n = len(self.names)
+        needed = n + len(names)
+        if needed > self.data.shape[0]:
+            capacity = max(needed, 2 * self.data.shape[0], 8)
+            data = np.zeros((capacity, self.data.shape[1]), dtype=self.data.dtype)
+            norms = np.zeros(capacity, dtype=np.float32)
+            data[:n] = self.data[:n]
+            norms[:n] = self.sq_norms[:n]
+            self.data, self.sq_norms = data, norms
+        self.data[n:needed] = rows
+        self.sq_norms[n:needed] = sq_norms
+        self.names.extend(names)
+        return n
+
+    def remove(self, row):
+        """
+        Swap-removes a row. Returns the name that moved into it, or None.
+        """
+        last = len(self.names) - 1
+        moved = None
+        if row != last:
+            self.data[row] = self.data[last]
+            self.sq_norms[row] = self.sq_norms[last]
+            moved = self.names[last]
+            self.names[row] = moved
+        self.names.pop()
+        return moved
+
+
+class IVFGallery:
+    """
+    Approximate nearest-neighbour gallery using an inverted file (IVF): the encodings
+    are clustered with k-means and a probe only scans the `nprobe` closest clusters.
+    With `pq_m` set, cluster residuals are stored as product-quantized uint8 codes
+    (pq_m bytes per face instead of 512) and distances are approximated from lookup tables.
+
+    Until `train_size` faces are registered the gallery answers with an exact scan,
+    since brute force is already fast at that size. The clustering is sized for the
+    gallery it was trained on; once the gallery has grown `retrain_factor` times past
+    that, needs_rebuild turns true and the owner should call rebuild() off the request path.
+    Exposes the same add / remove / best_match / snapshot interface as FaceGallery;
+    after a snapshot, each inverted list is copied before it is first changed.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, pq_m=0, train_size=10000, kmeans_iterations=10, seed=0,
+                 retrain_factor=4):
+        if pq_m and ENCODING_SIZE % pq_m:
+            raise ValueError(f'pq_m must divide {ENCODING_SIZE}.')
+        self.nlist = nlist
+        self.nprobe = nprobe # Higher probes more clusters: better recall, slower queries.
+        self.pq_m = pq_m
+        self.train_size = train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.retrain_factor = retrain_factor
+        self._trained_size = 0 # Faces registered when the clustering was last trained
+        self._rng = np.random.default_rng(seed)
+        self._pending = FaceGallery() # Exact scan used until the index is trained
+        self._centroids = None
+        self._codebooks = None # (pq_m, 256, dsub) when product quantization is on
+        self._pq_offsets = None
+        self._lists = []
+        self._where = {} # Maps { "name": (list_no, row) }
+        self._owned = set() # Inverted lists not shared with any snapshot
+        self._shared = False # _lists and _where are shared with a snapshot
+        self._frozen = False # This is a snapshot
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    @property
+    def needs_rebuild(self):
+        return self.is_trained and len(self._where) > self.retrain_factor * self._trained_size
+
+    def __len__(self):
+        return len(self._pending) + len(self._where)
+
+    def __contains__(self, name):
+        return name in self._where or name in self._pending
+
+    def names(self):
+        names = self._pending.names()
+        for inverted in self._lists:
+            names.extend(inverted.names)
+        return names
+
+    def get(self, name):
+        """
+        Returns the encoding for a name (reconstructed from its code when PQ is on), or None.
+        """
+        if name in self._pending:
+            return self._pending.get(name)
+        where = self._where.get(name)
+        if where is None:
+            return None
+        list_no, row = where
+        row_data = self._lists[list_no].data[row]
+        if self.pq_m:
+            return self._decode(row_data[None, :])[0] + self._centroids[list_no]
+        return row_data.copy()
+
+    def snapshot(self):
+        """
+        Returns a read-only copy of the gallery as it is now. Taking one is O(nlist).
+        """
+        view = copy.copy(self)
+        view._pending = self._pending.snapshot()
+        view._frozen = True
+        view._owned = frozenset()
+        self._shared = True
+        self._owned = set()
+        return view
+
+    def add(self, name, encoding):
+        self.add_many([name], np.asarray(encoding, dtype=np.float32).reshape(1, ENCODING_SIZE))
+
+    def add_many(self, names, encodings):
+        """
+        Registers (or replaces) many encodings at once.
+        """
+        self._unshare()
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        for name in names:
+            if name in self._where:
+                self.remove(name)
+        if not self.is_trained:
+            self._pending.add_many(names, encodings)
+            if len(self._pending) >= self.train_size:
+                self.train()
+            return
+        self._insert(list(names), encodings)
+
+    def remove(self, name):
+        self._unshare()
+        if self._pending.remove(name):
+            return True
+        where = self._where.pop(name, None)
+        if where is None:
+            return False
+        list_no, row = where
+        moved = self._writable(list_no).remove(row)
+        if moved is not None:
+            self._where[moved] = (list_no, row)
+        return True
+
+    def clear(self):
+        """
+        Removes every face but keeps the clustering, so reloading a similar gallery
+        only assigns faces to clusters instead of running k-means again.
+        """
+        self._unshare()
+        self._pending.clear()
+        if self.is_trained:
+            width, dtype = (self.pq_m, np.uint8) if self.pq_m else (ENCODING_SIZE, np.float32)
+            self._lists = [_InvertedList(width, dtype) for _ in range(len(self._centroids))]
+            self._owned = set(range(len(self._lists)))
+        self._where = {}
+
+    def train(self):
+        """
+        Clusters the registered encodings and moves them into the inverted lists.
+        """
+        self._unshare()
+        names = self._pending.names()
+        data = np.array(self._pending.encodings())
+        if len(names) == 0:
+            return
+        nlist = self.nlist or int(np.clip(np.sqrt(len(names)), 1, 4096))
+        sample = data
+        max_train = 64 * nlist
+        if len(data) > max_train:
+            sample = data[self._rng.choice(len(data), max_train, replace=False)]
+        self._centroids = _kmeans(sample, nlist, self.kmeans_iterations, self._rng)
+        if self.pq_m:
+            residuals = sample - self._centroids[_nearest_centroid(sample, self._centroids)]
+            dsub = ENCODING_SIZE // self.pq_m
+            self._codebooks = np.stack([
+                _kmeans(np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub]),
+                        PQ_CENTROIDS, self.kmeans_iterations, self._rng)
+                for j in range(self.pq_m)
+            ])
+            # Flat offsets of each subspace's row in the (pq_m, ksub) lookup table.
+            self._pq_offsets = np.arange(self.pq_m, dtype=np.intp) * self._codebooks.shape[1]
+        width, dtype = (self.pq_m, np.uint8) if self.pq_m else (ENCODING_SIZE, np.float32)
+        self._lists = [_InvertedList(width, dtype) for _ in range(len(self._centroids))]
+        self._owned = set(range(len(self._lists)))
+        self._where = {}
+        self._trained_size = len(names)
+        self._pending.clear()
+        self._insert(names, data)
+
+    def rebuild(self, names=None, encodings=None):
+        """
+        Re-trains the clustering, e.g. once needs_rebuild says the gallery has outgrown it,
+        and replaces the contents with the given faces. Without them it re-trains on what is
+        registered, which with PQ on are the lossy reconstructions.
+        """
+        if names is None:
+            names = self.names()
+            encodings = np.stack([self.get(name) for name in names]) if names else np.zeros((0, ENCODING_SIZE))
+        self._unshare()
+        self._centroids = None
+        self._codebooks = None
+        self._pq_offsets = None
+        self._lists = []
+        self._where = {}
+        self._pending.clear()
+        self._pending.add_many(names, encodings)
+        self.train()
+
+    def best_match(self, encoding, tolerance=DEFAULT_TOLERANCE):
+        if not self.is_trained:
+            return self._pending.best_match(encoding, tolerance=tolerance)
+        if not self._where:
+            return None, None
+        probe = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+        probe_sq = float(np.dot(probe, probe))
+        c_dist = np.einsum('ij,ij->i', self._centroids, self._centroids) - 2.0 * (self._centroids @ probe)
+        nprobe = min(self.nprobe, len(self._lists))
+        probed = np.argpartition(c_dist, nprobe - 1)[:nprobe]
+
+        if self.pq_m:
+            table = self._inner_product_table(probe).ravel()
+
+        best_name, best_sq = None, np.inf
+        for list_no in probed:
+            inverted = self._lists[list_no]
+            n = len(inverted)
+            if n == 0:
+                continue
+            if self.pq_m:
+                # ||q - c - r||^2 = ||q - c||^2 + (||r||^2 + 2<c, r>) - 2<q, r>; the middle term
+                # is stored per face and the last one is a lookup in the per-query table.
+                codes = inverted.data[:n].astype(np.intp) + self._pq_offsets
+                sq = c_dist[list_no] + probe_sq + inverted.sq_norms[:n] - 2.0 * np.take(table, codes).sum(axis=1)
+            else:
+                sq = inverted.sq_norms[:n] + probe_sq - 2.0 * (inverted.data[:n] @ probe)
+            row = int(np.argmin(sq))
+            if sq[row] < best_sq:
+                best_name, best_sq = inverted.names[row], float(sq[row])
+
+        if best_name is None:
+            return None, None
+        distance = float(np.sqrt(max(best_sq, 0.0)))
+        if distance <= tolerance:
+            return best_name, distance
+        return None, distance
+
+    def memory_bytes(self):
+        """
+        Approximate bytes held by the stored vectors or codes.
+        """
+        total = sum(inverted.data.nbytes + inverted.sq_norms.nbytes for inverted in self._lists)
+        if self._centroids is not None:
+            total += self._centroids.nbytes
+        if self._codebooks is not None:
+            total += self._codebooks.nbytes
+        return total + len(self._pending) * (ENCODING_SIZE + 1) * 4
+
+    def _insert(self, names, data):
+        assign = _nearest_centroid(data, self._centroids)
+        if self.pq_m:
+            rows = self._encode(data - self._centroids[assign])
+            decoded = self._decode(rows)
+            sq_norms = (np.einsum('ij,ij->i', decoded, decoded)
+                        + 2.0 * np.einsum('ij,ij->i', self._centroids[assign], decoded))
+        else:
+            rows = data
+            sq_norms = np.einsum('ij,ij->i', data, data)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.flatnonzero(np.diff(assign[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            list_no = int(assign[group[0]])
+            group_names = [names[i] for i in group]
+            first = self._writable(list_no).extend(rows[group], sq_norms[group], group_names)
+            for offset, name in enumerate(group_names):
+                self._where[name] = (list_no, first + offset)
+
+    def _unshare(self):
+        """
+        Gives the gallery its own list of inverted lists and name map before it
+        changes them, if a snapshot still uses them.
+        """
+        if self._frozen:
+            raise RuntimeError('Gallery snapshots are read-only.')
+        if self._shared:
+            self._lists = list(self._lists)
+            self._where = dict(self._where)
+            self._shared = False
+
+    def _writable(self, list_no):
+        """
+        Returns an inverted list for changing, copying it first if a snapshot shares it.
+        """
+        if list_no not in self._owned:
+            self._lists[list_no] = self._lists[list_no].copy()
+            self._owned.add(list_no)
+        return self._lists[list_no]
+
+    def _encode(self, residuals):
+        dsub = ENCODING_SIZE // self.pq_m
+        codes = np.empty((len(residuals), self.pq_m), dtype=np.uint8)
+        for j in range(self.pq_m):
+            sub = np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub])
+            codes[:, j] = _nearest_centroid(sub, self._codebooks[j])
+        return codes
+
+    def _decode(self, codes):
+        return np.concatenate([self._codebooks[j][codes[:, j]] for j in range(self.pq_m)], axis=1)
+
+    def _inner_product_table(self, probe):
+        """
+        Inner product of each probe subvector with every codeword: (pq_m, 256).
+        """
+        sub = probe.reshape(self.pq_m, 1, -1)
+        return (self._codebooks * sub).sum(axis=2)
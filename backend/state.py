@@ -0,0 +1,286 @@
+import contextlib
+import datetime
+import queue
+import threading
+from concurrent.futures import Future
+
+from attendance import AttendanceIndex
+from gallery import store_templates, template_keys
+from metrics import stage
+
+
+class GalleryState:
+    """
+    This process's view of the embedding store, published as an immutable gallery
+    snapshot. Readers take `snapshot` (or current()) and search it without locking.
+    Writers work on a private gallery under a lock and publish a new snapshot by
+    swapping that one reference, so searches already running finish on the one they
+    started with and a slow write never holds up recognition.
+
+    Other worker processes' writes are noticed through the store's shared version
+    counter, so checking for them costs one memory read per request. Every process
+    holds its own copy of the gallery (about 512 bytes per face) rather than searching
+    the store's mapped file.
+    """
+
+    def __init__(self, store, gallery):
+        self.store = store
+        self._gallery = gallery # Working copy, only used while holding _lock
+        self._lock = threading.Lock()
+        self._synced = None # Store version the working copy reflects
+        self.version = 0 # Snapshots published by this process
+        self.snapshot = gallery.snapshot()
+
+    def current(self):
+        """
+        Returns the latest snapshot, after picking up other processes' changes if the
+        store version moved. If another thread is already doing that, returns the
+        current snapshot rather than waiting for it.
+        """
+        if self.store.version != self._synced and self._lock.acquire(blocking=False):
+            try:
+                with stage('sync_state'):
+                    self._refresh()
+            finally:
+                self._lock.release()
+        return self.snapshot
+
+    def load(self):
+        """
+        Rebuilds the gallery from the whole store.
+        """
+        with self._lock:
+            self._reload()
+
+    def sync(self):
+        """
+        Applies every change in the store since the last sync, whatever the version says.
+        """
+        with self._lock:
+            self._refresh()
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        Yields the store for writing, as the only writer in this process, then
+        publishes a snapshot that includes the change.
+        """
+        with self._lock:
+            self._refresh()
+            yield self.store
+            self._refresh()
+
+    def store_templates(self, templates):
+        """
+        Replaces the reference encodings of each person in { "name": [encoding, ...] }.
+        """
+        with self.writing() as store:
+            store_templates(store, templates)
+
+    def remove_person(self, name):
+        """
+        Removes every reference encoding of a person. Returns True if there were any.
+        """
+        with self.writing() as store:
+            keys = template_keys(self._gallery, name)
+            for key in keys:
+                store.remove(key)
+        return bool(keys)
+
+    def maintain(self):
+        """
+        Fsyncs the store and compacts its journal once records have piled up. Re-trains
+        an approximate index that the gallery has outgrown, from the stored encodings;
+        searches keep using the previous snapshot meanwhile.
+        """
+        with self._lock:
+            self.store.sync()
+            if self.store.needs_compaction():
+                self.store.compact()
+            if self._gallery.needs_rebuild:
+                self._refresh()
+                self._gallery.rebuild(*self.store.items())
+                self._publish()
+
+    def _refresh(self):
+        version = self.store.version # Read first: a write after this moves it again
+        changes = self.store.refresh()
+        if changes is None: # Compacted by another process: reload everything
+            self._reload()
+            return
+        added = {} # Consecutive adds, applied together
+        for op, name, encoding in changes:
+            if op == 'add':
+                added[name] = encoding
+                continue
+            if added:
+                self._gallery.add_many(list(added), list(added.values()))
+                added = {}
+            self._gallery.remove(name)
+        if added:
+            self._gallery.add_many(list(added), list(added.values()))
+        self._synced = version
+        if changes:
+            self._publish()
+
+    def _reload(self):
+        version = self.store.version
+        names, encodings = self.store.load()
+        self._gallery.clear()
+        self._gallery.add_many(names, encodings)
+        self._synced = version
+        self._publish()
+
+    def _publish(self):
+        self.version += 1
+        self.snapshot = self._gallery.snapshot()
+
+
+class AttendanceWriter:
+    """
+    Owns this process's attendance log and index. Every change (recording an event,
+    deleting a user, clearing, compaction, picking up other processes' appends) runs
+    on one thread fed by a queue, so deciding between check-in and check-out and
+    appending the result can't interleave with another write. Recording also holds
+    the log's file lock, which keeps that decision consistent across processes.
+
+    Readers use `snapshot` (or current()), an immutable AttendanceIndex swapped in
+    after every change, without locking or waiting for the writer.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self._index = AttendanceIndex() # Only used on the writer thread
+        self._queue = queue.Queue()
+        self._synced = None # Log version the index reflects
+        self._refresh_queued = threading.Lock() # Held while a reader-requested refresh is queued
+        self.snapshot = self._index.snapshot()
+        self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def current(self):
+        """
+        Returns the latest snapshot without waiting. If the log version moved (another
+        process wrote), asks the writer to pick that up; until it has, readers get the
+        previous snapshot. Only one such refresh is queued at a time.
+        """
+        if self.log.version != self._synced and self._refresh_queued.acquire(blocking=False):
+            self._queue.put((None, self._queued_refresh, ()))
+        return self.snapshot
+
+    def load(self):
+        self._call(self._reload)
+
+    def sync(self):
+        """
+        Applies events appended to the latest loaded day or today since the last sync,
+        whatever the version says.
+        """
+        self._call(self._refresh)
+
+    def record(self, name, now, cooldown=0):
+        """
+        Records a check-in for a user, or a check-out if their last event today was a
+        check-in. With a cooldown (seconds), records nothing if their last event today
+        is more recent than that.
+        Returns (action_type, previous_type or None), or None if nothing was recorded.
+        """
+        return self._call(self._record, name, now, cooldown)
+
+    def delete_user(self, name):
+        """
+        Deletes a user's history. Returns True if they had any.
+        """
+        return self._call(self._delete_user, name)
+
+    def clear(self):
+        self._call(self._clear)
+
+    def maintain(self):
+        """
+        Fsyncs today's file and compacts the log once tombstones have piled up.
+        """
+        self._call(self._maintain)
+
+    def _call(self, function, *args):
+        future = Future()
+        self._queue.put((future, function, args))
+        return future.result()
+
+    def _run(self):
+        while True:
+            future, function, args = self._queue.get()
+            try:
+                result = function(*args)
+            except Exception as e:
+                if future is None:
+                    print(f"Error in attendance writer: {e}")
+                else:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+
+    # --- Writer thread only ---
+
+    def _queued_refresh(self):
+        try:
+            with stage('sync_state'):
+                self._refresh()
+        finally:
+            self._refresh_queued.release()
+
+    def _refresh(self):
+        version = self.log.version
+        events = self.log.refresh()
+        if events is None: # Log files compacted by another process
+            self._reload()
+            return
+        self._index.apply(events)
+        self._synced = version
+        if events:
+            self.snapshot = self._index.snapshot()
+
+    def _reload(self):
+        version = self.log.version
+        self._reset(self.log.load(), version)
+
+    def _reset(self, events, version):
+        self._index.reset(self.log.epoch)
+        self._index.apply(events)
+        self._synced = version
+        self.snapshot = self._index.snapshot()
+
+    def _record(self, name, now, cooldown):
+        with self.log.locked(): # No other process can append between the check and the write
+            self._refresh()
+            last_entry = self._index.last_entry(name, now.date().isoformat())
+            if cooldown and last_entry:
+                elapsed = now - datetime.datetime.fromisoformat(last_entry['timestamp'])
+                if elapsed.total_seconds() < cooldown:
+                    return None
+            action_type = 'check-out' if last_entry and last_entry['type'] == 'check-in' else 'check-in'
+            self.log.append(name, now, action_type)
+        self._refresh()
+        return action_type, (last_entry['type'] if last_entry else None)
+
+    def _delete_user(self, name):
+        self._refresh()
+        if name not in self._index:
+            return False
+        self.log.delete_user(name)
+        self._refresh()
+        return True
+
+    def _clear(self):
+        self.log.clear()
+        self._refresh()
+
+    def _maintain(self):
+        self.log.sync()
+        self._refresh() # Another process may have compacted already, clearing our tombstones
+        if self.log.needs_compaction():
+            version = self.log.version
+            self._reset(self.log.compact(), version)
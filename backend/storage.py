@@ -0,0 +1,615 @@
+import contextlib
+import csv
+import datetime
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from gallery import ENCODING_SIZE
+
+try:
+    import fcntl # POSIX only; Gunicorn deployments always have it
+except ImportError: # pragma: no cover - Windows dev server runs a single process
+    fcntl = None
+
+
+@contextlib.contextmanager
+def _locked(lock_path):
+    """
+    Holds an exclusive advisory lock on lock_path so several worker processes
+    can append to the same files without interleaving.
+    """
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _terminate_torn_line(path):
+    """
+    Ends a trailing partial line left by a writer that crashed mid-append, so the
+    next append starts on a line of its own.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as log:
+        log.seek(-1, os.SEEK_END)
+        if log.read(1) != b'\n':
+            log.write(b'\n')
+
+
+def _fsync_path(path):
+    if os.path.exists(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class VersionCounter:
+    """
+    A number shared by every worker process through an 8-byte memory-mapped file.
+    A store bumps it (under the store's lock) after every write, so readers find out
+    whether anything changed with one memory read instead of reading the store files.
+    A read racing with a bump may see a torn value; that only causes an extra refresh.
+    """
+
+    def __init__(self, path):
+        with open(path, 'ab') as counter:
+            if counter.tell() < 8:
+                counter.truncate(8)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 8)
+
+    @property
+    def value(self):
+        return struct.unpack_from('<Q', self._map)[0]
+
+    def bump(self):
+        """
+        Increments the counter. Callers must hold the lock of the store it belongs to.
+        """
+        struct.pack_into('<Q', self._map, 0, self.value + 1)
+
+
+class EmbeddingStore:
+    """
+    Disk-backed face encodings shared by every worker process.
+
+    Encodings live in a raw float32 (capacity x 128) file that is memory-mapped, so
+    startup does not re-read or re-encode images. The mapping is only used to persist
+    and load them: each process searches its own in-memory gallery built from it.
+    Which name owns which row is recorded in an append-only JSON-lines journal:
+        {"op": "add", "name": "...", "slot": 3}
+        {"op": "add", "names": ["...", ...], "slots": [4, ...]}
+        {"op": "del", "name": "..."}
+    compact() rewrites it as a single batched add of every live face, so a cold
+    start parses one line however large the gallery is.
+    A row is always written before the journal line that points at it, so a crash
+    can at worst leave an unreferenced row behind. Writes are flushed to the OS on
+    every request but only fsynced by sync(), which the app calls periodically.
+    `version` changes whenever any process writes to the store.
+    """
+
+    def __init__(self, directory, initial_capacity=1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.matrix_path = os.path.join(directory, 'encodings.f32')
+        self.journal_path = os.path.join(directory, 'names.log')
+        self.lock_path = os.path.join(directory, '.lock')
+        self.initial_capacity = initial_capacity
+        self._version = VersionCounter(os.path.join(directory, 'version'))
+        self._matrix = None
+        self._slots = {} # Maps { "name": slot }
+        self._free = set()
+        self._high_water = 0 # One past the highest slot ever handed out
+        self._offset = 0 # Bytes of the journal already applied
+        self._journal_id = None
+        self._records = 0
+        self._changes = [] # Applied but not yet handed out by refresh()
+        self._reload_needed = False
+
+        with _locked(self.lock_path):
+            if not os.path.exists(self.matrix_path):
+                self._resize_file(initial_capacity)
+            open(self.journal_path, 'a').close()
+        self._map()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def load(self):
+        """
+        Replays the whole journal. Returns (names, encodings) for every stored face.
+        """
+        self._slots = {}
+        self._free = set()
+        self._high_water = 0
+        self._offset = 0
+        self._records = 0
+        self._journal_id = self._stat_id()
+        self._changes = []
+        self._apply(self._read_journal(), track=False)
+        # A compacted journal doesn't list freed rows, so recover them as the unused ones.
+        self._free = set(range(self._high_water)).difference(self._slots.values())
+        return self.items()
+
+    def items(self):
+        names = list(self._slots)
+        rows = np.fromiter(self._slots.values(), dtype=np.int64, count=len(names))
+        return names, self._matrix[rows]
+
+    def refresh(self):
+        """
+        Returns every change since the last load/refresh, whether written by this
+        process or another, as (op, name, encoding-or-None). Returns None when the
+        journal was compacted elsewhere and the caller should reload with load().
+        """
+        if self._reload_needed or self._stat_id() != self._journal_id:
+            self._reload_needed = False
+            return None
+        self._apply(self._read_journal())
+        changes, self._changes = self._changes, []
+        return [
+            (op, name, self._matrix[slot].copy() if op == 'add' else None)
+            for op, name, slot in changes
+        ]
+
+    def add(self, name, encoding):
+        self.add_many([name], encoding)
+
+    def add_many(self, names, encodings):
+        """
+        Stores (or replaces) encodings. Rows are written before the journal records
+        that reference them.
+        """
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with _locked(self.lock_path):
+            self._catch_up()
+            slots = []
+            for encoding in encodings:
+                slot = self._free.pop() if self._free else self._next_slot()
+                self._matrix[slot] = encoding
+                slots.append(slot)
+            if len(slots) == 1:
+                self._append({'op': 'add', 'name': names[0], 'slot': slots[0]})
+            elif slots:
+                self._append({'op': 'add', 'names': list(names), 'slots': slots})
+
+    def remove(self, name):
+        with _locked(self.lock_path):
+            self._catch_up()
+            if name not in self._slots:
+                return False
+            self._append({'op': 'del', 'name': name})
+            return True
+
+    def sync(self):
+        """
+        Forces encodings and journal to stable storage.
+        """
+        if self._matrix is not None:
+            self._matrix.flush()
+        _fsync_path(self.journal_path)
+
+    def needs_compaction(self):
+        return self._records > len(self._slots) // 4 + 1000
+
+    def compact(self):
+        """
+        Rewrites the journal as one batched add record of every live face.
+        """
+        with _locked(self.lock_path):
+            self._catch_up()
+            self.sync()
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'w') as journal:
+                if self._slots:
+                    record = {'op': 'add', 'names': list(self._slots), 'slots': list(self._slots.values())}
+                    journal.write(json.dumps(record) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(tmp_path, self.journal_path)
+            self._version.bump()
+            # Same live set as before, so just start reading the new file at its end.
+            self._journal_id = self._stat_id()
+            self._offset = os.path.getsize(self.journal_path)
+            self._records = 1 if self._slots else 0
+
+    def _catch_up(self):
+        if self._stat_id() != self._journal_id:
+            self.load()
+            self._reload_needed = True # The next refresh() tells the caller to reload too
+        else:
+            self._apply(self._read_journal())
+
+    def _append(self, *records):
+        _terminate_torn_line(self.journal_path)
+        with open(self.journal_path, 'a') as journal:
+            journal.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._version.bump()
+        self._apply(self._read_journal())
+
+    def _apply(self, records, track=True):
+        for record in records:
+            op = record['op']
+            if 'names' in record:
+                names, slots = record['names'], record['slots']
+                fresh = self._slots.keys().isdisjoint(names) and len(set(names)) == len(names)
+                if op == 'add' and slots and fresh:
+                    # All new names, as in a compacted journal: apply the batch in bulk.
+                    if max(slots) >= self._matrix.shape[0]:
+                        self._map()
+                    self._free.difference_update(slots)
+                    self._high_water = max(self._high_water, max(slots) + 1)
+                    self._slots.update(zip(names, slots))
+                    if track:
+                        self._changes.extend((op, name, slot) for name, slot in zip(names, slots))
+                    continue
+                entries = zip(names, slots)
+            else:
+                entries = [(record['name'], record.get('slot'))]
+            for name, slot in entries:
+                old = self._slots.pop(name, None)
+                if old is not None:
+                    self._free.add(old)
+                if track:
+                    self._changes.append((op, name, slot))
+                if op == 'add':
+                    if slot >= self._matrix.shape[0]:
+                        self._map() # Another process grew the file
+                    self._free.discard(slot)
+                    if slot >= self._high_water:
+                        self._high_water = slot + 1
+                    self._slots[name] = slot
+        self._records += len(records)
+
+    def _read_journal(self):
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(self._offset)
+            data = journal.read()
+        # Ignore a trailing partial line from a writer that crashed mid-append.
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        lines = data[:end].splitlines()
+        try:
+            return json.loads(b'[' + b','.join(lines) + b']') # One parse for the whole batch
+        except ValueError:
+            pass
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue # Torn line from a crashed writer, terminated by the next append
+        return records
+
+    def _next_slot(self):
+        if self._high_water >= self._matrix.shape[0]:
+            self._resize_file(2 * self._matrix.shape[0])
+            self._map()
+        self._high_water += 1
+        return self._high_water - 1
+
+    def _resize_file(self, capacity):
+        with open(self.matrix_path, 'ab') as matrix:
+            matrix.truncate(capacity * ENCODING_SIZE * 4)
+
+    def _map(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+        rows = os.path.getsize(self.matrix_path) // (ENCODING_SIZE * 4)
+        self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode='r+', shape=(rows, ENCODING_SIZE))
+
+    def _stat_id(self):
+        stat = os.stat(self.journal_path)
+        return (stat.st_dev, stat.st_ino)
+
+
+class EncodingCache:
+    """
+    Encodings of images that were already processed, keyed by a content hash of the
+    image bytes, so importing the same photos again never re-runs detection and encoding.
+
+    Encodings are appended to a raw float32 file and an append-only JSON-lines index
+    points at them; images without a usable face are cached with their error:
+        {"key": "<sha256>:1:640", "row": 12}
+        {"key": "<sha256>:1:640", "row": null, "error": "No face detected in the image."}
+    As in EmbeddingStore, the row is written before the index line that refers to it.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, 'cache.f32')
+        self.index_path = os.path.join(directory, 'cache.log')
+        self.lock_path = os.path.join(directory, '.lock')
+        self._entries = {} # Maps { "key": (row or None, error or None) }
+        self._offset = 0 # Bytes of the index already read
+        self._vectors = None
+        open(self.index_path, 'a').close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(image_bytes, *settings):
+        """
+        Cache key of an image: its SHA-256 plus any settings that change the encoding
+        (decode reduction, detection width).
+        """
+        return ':'.join([hashlib.sha256(image_bytes).hexdigest(), *map(str, settings)])
+
+    def refresh(self):
+        """
+        Reads index entries added since the last call, by this or any other process.
+        """
+        with open(self.index_path, 'rb') as index:
+            index.seek(self._offset)
+            data = index.read()
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Torn line from a crashed writer
+            self._entries[record['key']] = (record['row'], record.get('error'))
+
+    def get(self, key):
+        """
+        Returns (encoding or None, error or None) for a cached image, or None if it isn't cached.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        row, error = entry
+        if row is None:
+            return None, error
+        if self._vectors is None or row >= self._vectors.shape[0]:
+            rows = os.path.getsize(self.vectors_path) // (ENCODING_SIZE * 4)
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, ENCODING_SIZE))
+        return np.array(self._vectors[row]), None
+
+    def put(self, key, encoding, error=None):
+        """
+        Caches the encoding of an image, or (with encoding None) why it has none.
+        """
+        row = None
+        with _locked(self.lock_path):
+            if encoding is not None:
+                row_bytes = ENCODING_SIZE * 4
+                with open(self.vectors_path, 'ab') as vectors:
+                    # Drop a partial row left by a writer that crashed mid-write; no index line points at it.
+                    row = vectors.tell() // row_bytes
+                    vectors.truncate(row * row_bytes)
+                    vectors.write(np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE).tobytes())
+            record = {'key': key, 'row': row}
+            if error:
+                record['error'] = error
+            _terminate_torn_line(self.index_path)
+            with open(self.index_path, 'a') as index:
+                index.write(json.dumps(record) + '\n')
+        self._entries[key] = (row, error)
+
+
+class AttendanceLog:
+    """
+    Append-only attendance history in per-day CSV files,
+    backend/attendance_logs/<YYYY-MM-DD>_attendance.csv with columns Name,Time,Type.
+
+    Deleting a user or clearing all attendance appends a tombstone row
+    (Type 'deleted' / 'cleared') instead of rewriting history; compact() later
+    rewrites the files without the rows those tombstones cancel. Every append is
+    flushed to the OS so it survives a process crash; sync() fsyncs periodically.
+    `version` changes whenever any process appends or compacts.
+    """
+
+    FIELDS = ['Name', 'Time', 'Type']
+    SUFFIX = '_attendance.csv'
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock_path = os.path.join(directory, '.lock')
+        self.epoch_path = os.path.join(directory, '.epoch')
+        self.epoch = 0 # Bumped by every compaction, which rewrites history
+        self._offsets = {} # Maps { "date": (file id, bytes applied) }
+        self._tombstones = 0
+        self._version = VersionCounter(os.path.join(directory, '.version'))
+        self._holding_lock = False
+
+    @property
+    def version(self):
+        return self._version.value
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the log's cross-process lock, so a caller can read the latest events and
+        append based on them without another process appending in between. append()
+        and compact() may be called inside it. Not thread-safe: use from one thread.
+        """
+        if self._holding_lock:
+            yield
+            return
+        with _locked(self.lock_path):
+            self._holding_lock = True
+            try:
+                yield
+            finally:
+                self._holding_lock = False
+
+    def path_for(self, date):
+        return os.path.join(self.directory, f"{date.isoformat()}{self.SUFFIX}")
+
+    def dates(self):
+        dates = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.SUFFIX):
+                try:
+                    dates.append(datetime.date.fromisoformat(filename[:-len(self.SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(dates)
+
+    def load(self):
+        """
+        Reads every day file. Returns events as (name, iso_timestamp, type) in order.
+        """
+        self._offsets = {}
+        self._tombstones = 0
+        self.epoch = self._read_epoch()
+        events = []
+        for date in self.dates():
+            events.extend(self._read_new(date))
+        return events
+
+    def refresh(self, today=None):
+        """
+        Returns events appended (by any process) since the last load/refresh,
+        or None when the files were compacted and the caller should load() again.
+        """
+        if self._read_epoch() != self.epoch:
+            return None
+        known = sorted(self._offsets)
+        dates = set(known[-1:])
+        dates.add(today or datetime.date.today())
+        events = []
+        for date in sorted(dates):
+            path = self.path_for(date)
+            if date in self._offsets and (not os.path.exists(path) or self._offsets[date][0] != self._file_id(path)):
+                return None
+            events.extend(self._read_new(date))
+        return events
+
+    def append(self, name, timestamp, action_type):
+        """
+        Appends one event; timestamp is a datetime.
+        """
+        with self.locked():
+            path = self.path_for(timestamp.date())
+            new_file = not os.path.exists(path)
+            _terminate_torn_line(path)
+            with open(path, 'a', newline='') as log:
+                writer = csv.writer(log)
+                if new_file:
+                    writer.writerow(self.FIELDS)
+                writer.writerow([name, timestamp.time().isoformat(), action_type])
+            self._version.bump()
+
+    def delete_user(self, name, timestamp=None):
+        self.append(name, timestamp or datetime.datetime.now(), 'deleted')
+
+    def clear(self, timestamp=None):
+        self.append('', timestamp or datetime.datetime.now(), 'cleared')
+
+    def sync(self):
+        _fsync_path(self.path_for(datetime.date.today()))
+
+    def needs_compaction(self):
+        return self._tombstones > 0
+
+    def compact(self):
+        """
+        Rewrites the day files, dropping rows cancelled by later tombstones and the
+        tombstones themselves. Files left empty are removed. The epoch only moves when
+        a file actually changed, since that invalidates every client's version.
+        """
+        with self.locked():
+            deleted = set()
+            cleared = False
+            changed = False
+            for date in reversed(self.dates()):
+                path = self.path_for(date)
+                with open(path, newline='') as log:
+                    # By position, like _read_new(): old files have a Name,Time header but Type rows.
+                    rows = [row for row in csv.reader(log) if len(row) >= 2 and row[:2] != self.FIELDS[:2]]
+                kept = []
+                for row in reversed(rows):
+                    name, time = row[0], row[1]
+                    action_type = row[2] if len(row) > 2 and row[2] else 'check-in'
+                    if action_type == 'cleared':
+                        cleared = True
+                    elif action_type == 'deleted':
+                        deleted.add(name)
+                    elif not cleared and name not in deleted:
+                        kept.append([name, time, action_type])
+                if len(kept) == len(rows):
+                    continue
+                changed = True
+                if not kept:
+                    os.remove(path)
+                    continue
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w', newline='') as log:
+                    writer = csv.writer(log)
+                    writer.writerow(self.FIELDS)
+                    writer.writerows(reversed(kept))
+                    log.flush()
+                    os.fsync(log.fileno())
+                os.replace(tmp_path, path)
+            if changed:
+                epoch = self._read_epoch() + 1
+                tmp_path = self.epoch_path + '.tmp'
+                with open(tmp_path, 'w') as epoch_file:
+                    epoch_file.write(str(epoch))
+                    epoch_file.flush()
+                    os.fsync(epoch_file.fileno())
+                os.replace(tmp_path, self.epoch_path)
+                self._version.bump()
+        return self.load()
+
+    def _read_new(self, date):
+        path = self.path_for(date)
+        if not os.path.exists(path):
+            return []
+        file_id, offset = self._offsets.get(date, (self._file_id(path), 0))
+        with open(path, 'rb') as log:
+            log.seek(offset)
+            data = log.read()
+        end = data.rfind(b'\n') + 1 # Leave a partially written last line for next time
+        self._offsets[date] = (file_id, offset + end)
+        events = []
+        text = data[:end].decode('utf-8')
+        for row in csv.reader(io.StringIO(text)):
+            if len(row) < 2 or row[:2] == self.FIELDS[:2]: # Header, including the old Name,Time one
+                continue
+            name, time = row[0], row[1]
+            try:
+                datetime.time.fromisoformat(time)
+            except ValueError:
+                continue # Torn line from a crashed writer
+            action_type = row[2] if len(row) > 2 and row[2] else 'check-in'
+            if action_type in ('deleted', 'cleared'):
+                self._tombstones += 1
+            events.append((name, f"{date.isoformat()}T{time}", action_type))
+        return events
+
+    def _read_epoch(self):
+        try:
+            with open(self.epoch_path) as epoch_file:
+                return int(epoch_file.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def _file_id(path):
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino)
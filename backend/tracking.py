@@ -0,0 +1,99 @@
+import itertools
+
+
+def iou(a, b):
+    """
+    Intersection over union of two (top, right, bottom, left) boxes.
+    """
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    if intersection == 0:
+        return 0.0
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class Track:
+    """
+    One face followed across frames.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, box, now):
+        self.id = next(self._ids)
+        self.box = box
+        self.first_seen = now
+        self.last_seen = now
+        self.hits = 1
+        self.misses = 0
+        self.name = None # Set once the face has been recognized
+        self.distance = None
+        self.last_encoded = None # When the face was last encoded, while still unrecognized
+        self.recorded = False # Attendance already handled for this track
+
+    def to_json(self, scale=1):
+        """
+        The track for the client, with its box multiplied by scale (the decode
+        reduction) so it is in the coordinates of the uploaded frame.
+        """
+        top, right, bottom, left = (v * scale for v in self.box)
+        return {
+            'id': self.id,
+            'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
+            'name': self.name,
+            'distance': self.distance,
+        }
+
+
+class FaceTracker:
+    """
+    Lightweight box tracker for a camera stream: detections in a new frame are matched to
+    existing tracks by greedy IoU, so a face only needs the expensive 128-d encoding when
+    its track is new or still unrecognized, not on every frame.
+
+    Unrecognized tracks are re-encoded at most every `retry_interval` seconds, and a track
+    disappears after `max_missed` frames without a matching detection.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=15, retry_interval=1.0):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.retry_interval = retry_interval
+        self.tracks = []
+
+    def update(self, boxes, now):
+        """
+        Feeds one frame's detections (top, right, bottom, left). Returns the live tracks.
+        """
+        pairs = sorted(
+            ((iou(track.box, box), t, b) for t, track in enumerate(self.tracks) for b, box in enumerate(boxes)),
+            reverse=True,
+        )
+        matched_tracks, matched_boxes = set(), set()
+        for overlap, t, b in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in matched_tracks or b in matched_boxes:
+                continue
+            track = self.tracks[t]
+            track.box = boxes[b]
+            track.last_seen = now
+            track.hits += 1
+            track.misses = 0
+            matched_tracks.add(t)
+            matched_boxes.add(b)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_missed]
+        self.tracks.extend(Track(box, now) for b, box in enumerate(boxes) if b not in matched_boxes)
+        return [track for track in self.tracks if track.misses == 0]
+
+    def needs_encoding(self, track, now):
+        if track.name is not None or track.misses:
+            return False
+        return track.last_encoded is None or now - track.last_encoded >= self.retry_interval
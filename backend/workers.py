@@ -0,0 +1,134 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import face_recognition
+import numpy as np
+
+from imaging import decode_bytes, encode_faces, scale_box
+from metrics import disable_stages
+
+
+class PoolSaturated(Exception):
+    """
+    Raised when the encoder pool already has as many images queued as it allows.
+    """
+
+
+def _warm_up_worker():
+    # Forked from a threaded server: never touch the metric locks inherited from it.
+    disable_stages()
+    # Keep OpenCV to one thread per worker; the pool itself provides the parallelism.
+    cv2.setNumThreads(1)
+    # Run the detector and encoder once so the dlib models are loaded before real work arrives.
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_encodings(blank, [(8, 56, 56, 8)])
+    face_recognition.face_locations(blank)
+
+
+def _ping():
+    return True
+
+
+def detect_and_encode(image_bytes, reduction=1, detect_max_width=0):
+    """
+    Runs in a pool worker: decodes an encoded image (JPEG/WebP/PNG/...) and returns
+    [((top, right, bottom, left), encoding), ...] for every face found, with boxes in
+    the coordinates of the uploaded image even when it was decoded at reduced size.
+    """
+    image = decode_bytes(image_bytes, reduction)
+    if image is None:
+        raise ValueError('Invalid image data.')
+    faces = encode_faces(image, detect_max_width)
+    if reduction == 1:
+        return faces
+    return [(scale_box(box, reduction), encoding) for box, encoding in faces]
+
+
+class EncoderPool:
+    """
+    Process pool for face detection and encoding, so batch work scales with cores
+    instead of being bound to the request thread.
+
+    Every worker loads the dlib models once when the pool starts. At most
+    `max_pending` images may be queued or in progress; submit_many() raises
+    PoolSaturated instead of queueing more, so callers can answer 429.
+    """
+
+    def __init__(self, workers, max_pending, reduction=1, detect_max_width=0):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.reduction = reduction
+        self.detect_max_width = detect_max_width
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def start(self):
+        """
+        Starts the worker processes and waits until each has loaded the models.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+                executor = self._executor
+            else:
+                return
+        for future in [executor.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+
+    def submit_many(self, payloads):
+        """
+        Queues detect_and_encode for every payload. Returns one future per payload.
+        """
+        self.start()
+        with self._lock:
+            if self._pending + len(payloads) > self.max_pending:
+                raise PoolSaturated(f'{self._pending} images already queued.')
+            self._pending += len(payloads)
+        futures = []
+        try:
+            for payload in payloads:
+                futures.append(self._submit(payload))
+        except BrokenProcessPool:
+            self._restart()
+            with self._lock:
+                # Futures already handed to the broken pool release their own slot when they fail.
+                self._pending += len(futures)
+            futures = [self._submit(payload) for payload in payloads]
+        return futures
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, payload):
+        future = self._executor.submit(detect_and_encode, payload, self.reduction, self.detect_max_width)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._lock:
+            self._pending -= 1
+
+    def _restart(self):
+        print("Encoder pool broke (a worker died); restarting it.")
+        with self._lock:
+            broken, self._executor = self._executor, self._create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _create_executor(self):
+        # Fork where available: workers start instantly and share the parent's loaded modules,
+        # and unlike forkserver / spawn don't re-run app.py's startup under `python app.py`.
+        # Workers turn stage timing off, so they never wait on a lock inherited mid-use.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_warm_up_worker)
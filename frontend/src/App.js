@@ -14,6 +14,8 @@ function App() {
   const [knownFaces, setKnownFaces] = useState([]);
   // useState to store all attendance records (for admin view)
   const [allAttendance, setAllAttendance] = useState({});
+  // useRef to remember the attendance version last received, so polls only fetch what changed
+  const attendanceVersionRef = useRef(null);
   // useState to manage loading state during API calls
   const [isLoading, setIsLoading] = useState(false);
   // useState to manage the current user role ('landing', 'guest', 'admin')
@@ -30,6 +32,9 @@ function App() {
   // States specific to the Guest (User) view - simplified
   const [recognizedUserName, setRecognizedUserName] = useState(null);
   const [recognizedActionType, setRecognizedActionType] = useState(null); // To store 'check-in' or 'check-out'
+  // Live (streaming) attendance mode: the open WebSocket and whether it is running
+  const liveSocketRef = useRef(null);
+  const [isLive, setIsLive] = useState(false);
 
   // Base URL for the backend API
   const API_BASE_URL = 'http://127.0.0.1:5000'; // Ensure this matches your Flask backend URL
@@ -97,11 +102,30 @@ function App() {
         console.error(`Error fetching known faces: ${facesData.message}`);
       }
 
-      // Fetch all attendance records
-      const attendanceResponse = await fetch(`${API_BASE_URL}/get_attendance`);
+      // Fetch attendance: the full history the first time, afterwards only events since the last version
+      const version = attendanceVersionRef.current;
+      const attendanceUrl = version
+        ? `${API_BASE_URL}/get_attendance?since=${encodeURIComponent(version)}`
+        : `${API_BASE_URL}/get_attendance`;
+      const attendanceResponse = await fetch(attendanceUrl);
+      if (attendanceResponse.status === 304) {
+        return; // Nothing new since the last poll
+      }
       const attendanceData = await attendanceResponse.json();
       if (attendanceData.success) {
-        setAllAttendance(attendanceData.attendance);
+        attendanceVersionRef.current = attendanceData.version;
+        if (attendanceData.events) {
+          // Merge the new events into the records we already have
+          setAllAttendance(prevAttendance => {
+            const merged = { ...prevAttendance };
+            attendanceData.events.forEach(({ name: personName, timestamp, type }) => {
+              merged[personName] = [...(merged[personName] || []), { timestamp, type }];
+            });
+            return merged;
+          });
+        } else {
+          setAllAttendance(attendanceData.attendance);
+        }
       } else {
         console.error(`Error fetching all attendance: ${attendanceData.message}`);
       }
@@ -132,13 +156,13 @@ function App() {
     };
   }, [currentRole, currentAdminView]); // Dependencies: re-run if role or admin view changes
 
-  // Function to capture a frame from the video stream
+  // Function to capture a frame from the video stream as a JPEG Blob (resolves to null on failure)
   const captureFrame = () => {
     // Ensure videoRef.current exists AND the video is ready to play (readyState >= 2)
     // readyState 0: HAVE_NOTHING, 1: HAVE_METADATA, 2: HAVE_CURRENT_DATA, 3: HAVE_FUTURE_DATA, 4: HAVE_ENOUGH_DATA
     if (!videoRef.current || videoRef.current.readyState < 2) {
       setMessage('Video stream not ready. Please wait or check webcam connection/permissions.');
-      return null;
+      return Promise.resolve(null);
     }
 
     const canvas = document.createElement('canvas');
@@ -146,8 +170,8 @@ function App() {
     canvas.height = videoRef.current.videoHeight;
     const context = canvas.getContext('2d');
     context.drawImage(videoRef.current, 0, 0, canvas.width, canvas.height);
-    const imageData = canvas.toDataURL('image/png');
-    return imageData.split(',')[1];
+    // JPEG is a fraction of the size of a base64 PNG and is uploaded as raw bytes
+    return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.9));
   };
 
   // Function to register a new face (Admin only)
@@ -157,7 +181,7 @@ function App() {
       return;
     }
 
-    const imageData = captureFrame();
+    const imageData = await captureFrame();
     if (!imageData) {
       setMessage('Failed to capture image for registration. Is webcam active?');
       return;
@@ -167,12 +191,12 @@ function App() {
     setMessage('Registering face...');
 
     try {
+      const formData = new FormData();
+      formData.append('image', imageData, 'face.jpg');
+      formData.append('name', name.trim());
       const response = await fetch(`${API_BASE_URL}/register_face`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ image: imageData, name: name.trim() }),
+        body: formData,
       });
 
       const data = await response.json();
@@ -191,9 +215,67 @@ function App() {
     }
   };
 
+  // Function to stop live attendance mode
+  const stopLiveAttendance = () => {
+    if (liveSocketRef.current) {
+      liveSocketRef.current.close();
+      liveSocketRef.current = null;
+    }
+    setIsLive(false);
+  };
+
+  // Function to start live attendance mode: streams frames over a WebSocket and shows each
+  // check-in/out the backend records. The next frame is sent once the previous one is answered.
+  const startLiveAttendance = () => {
+    const socket = new WebSocket(`${API_BASE_URL.replace(/^http/, 'ws')}/recognize_stream`);
+    socket.binaryType = 'arraybuffer';
+    liveSocketRef.current = socket;
+
+    const sendNextFrame = async () => {
+      const frame = await captureFrame();
+      if (liveSocketRef.current === socket && socket.readyState === WebSocket.OPEN) {
+        if (frame) {
+          socket.send(frame);
+        } else {
+          setTimeout(sendNextFrame, 500); // Video not ready yet; try again shortly
+        }
+      }
+    };
+
+    socket.onopen = () => {
+      setIsLive(true);
+      setMessage('Live attendance is on. Step in front of the camera!');
+      sendNextFrame();
+    };
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.success && data.events.length > 0) {
+        const lastEvent = data.events[data.events.length - 1];
+        setMessage(lastEvent.message);
+        setRecognizedUserName(lastEvent.name);
+        setRecognizedActionType(lastEvent.action_type);
+      }
+      sendNextFrame();
+    };
+    socket.onerror = () => {
+      setMessage('Error: Could not connect to backend for live attendance.');
+    };
+    socket.onclose = () => {
+      if (liveSocketRef.current === socket) {
+        liveSocketRef.current = null;
+        setIsLive(false);
+      }
+    };
+  };
+
+  // Effect hook to stop live attendance when leaving the guest view
+  useEffect(() => {
+    return () => stopLiveAttendance();
+  }, [currentRole]);
+
   // Function to recognize a face and record attendance (Guest or Admin)
   const handleRecognizeFace = async () => {
-    const imageData = captureFrame();
+    const imageData = await captureFrame();
     if (!imageData) {
       setMessage('Failed to capture image for recognition. Is webcam active?');
       return;
@@ -208,9 +290,9 @@ function App() {
       const response = await fetch(`${API_BASE_URL}/recognize_face`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json',
+          'Content-Type': 'image/jpeg',
         },
-        body: JSON.stringify({ image: imageData }),
+        body: imageData,
       });
 
       const data = await response.json();
@@ -428,6 +510,13 @@ function App() {
                 >
                   {isLoading ? 'Processing...' : 'Recognize & Record Attendance'}
                 </button>
+                <button
+                  onClick={isLive ? stopLiveAttendance : startLiveAttendance}
+                  className="w-full mt-4 bg-teal-600 text-white py-3 rounded-xl hover:bg-teal-700 transition duration-300 ease-in-out disabled:opacity-50 disabled:cursor-not-allowed font-semibold shadow-md"
+                  disabled={!stream}
+                >
+                  {isLive ? 'Stop Live Attendance' : 'Start Live Attendance'}
+                </button>
 
                 {/* Removed the redundant message display here */}
                 {recognizedUserName && (